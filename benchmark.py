@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Script times stats.py on synthetic hand history databases made by generate.py, for cash games and tournaments
+at several sizes (e.g., 10k to 10M hands). Each size is timed twice: a cold run that calculates stats for every
+hand, and an incremental run after adding a smaller batch of new hands.
+Generated databases are kept and reused, so different versions of stats.py are timed on the same hands.
+Results are appended to a CSV file (one row per run) so engine changes can be compared over time.
+With --compare, each size is also timed with the action stats run as one UPDATE per column (calc_action), as
+before the stat registry grouped them into one query per JOIN (calc_batch).
+Uses config.toml for the stats.py settings (e.g., batch mode); test_run and the small database are ignored.
+"""
+
+import argparse  # command line options
+import contextlib  # quiet stats output
+import csv  # results file
+import os  # database files
+import platform  # results file
+import shutil  # copy generated databases
+import sqlite3  # sqlite version
+import time  # timing
+
+import generate
+import stats
+
+grouped_calc_batch = stats.calc_batch
+
+
+def calc_per_column(conn, stat_list, join=None):
+    '''Stand-in for stats.calc_batch() that runs each of the action stats
+    (stat_list) as its own calc_action() UPDATE, for --compare.'''
+
+    for stat in stat_list:
+        if stat['kind'] == 'derived':
+            (stat_cond, stat_cond2) = ('True', stat['cond'])
+        else:
+            (stat_cond, stat_cond2) = (stat['cond'], stat['cond2'])
+        stats.calc_action(conn, stat['name'], stat_cond, stat_cond2, stat['val'],
+                          join_hands=(join == 'hands'), join_p_hands=(join == 'p_hands'))
+
+
+def time_stats(db_name, is_tourney, verbose=False):
+    '''Runs the full stats.py pipeline on (db_name).
+    Returns a tuple of (number of new actions, number of new hands, elapsed seconds).'''
+
+    db = {'db_name': db_name, 'db_name_test': db_name, 'is_tourney': is_tourney, 'clear_db': False}
+    if verbose:
+        result = stats.run_database(db)
+    else:
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            result = stats.run_database(db)
+    (_, num_new_actions, num_new_hands, elapsed, _) = result
+    return (num_new_actions, num_new_hands, elapsed)
+
+
+def run_benchmark(num_hands, is_tourney, inc_hands, bench_dir, regenerate=False, verbose=False):
+    '''Times a cold and an incremental stats run on a database of (num_hands)
+    generated hands, adding (inc_hands) hands for the incremental run.
+    The generated database is kept in (bench_dir) and reused unless
+    (regenerate) is set. Returns a list of result dicts.'''
+
+    kind = 'tourney' if is_tourney else 'cash'
+    base_name = os.path.join(bench_dir, f'{kind}_{num_hands}_base.sqlite')
+    db_name = os.path.join(bench_dir, f'{kind}_{num_hands}.sqlite')
+
+    if regenerate or not os.path.exists(base_name):
+        if os.path.exists(base_name):
+            os.remove(base_name)
+        print(f'Generating {num_hands} {kind} hands...')
+        begin_time = time.perf_counter()
+        generate.generate(base_name, num_hands, num_players=max(30, num_hands // 2000),
+                          is_tourney=is_tourney, seed=num_hands)
+        print(f'...{time.perf_counter() - begin_time:.1f} s')
+
+    shutil.copyfile(base_name, db_name)
+
+    result_list = []
+    for phase in ('cold', 'incremental'):
+        if phase == 'incremental':
+            generate.generate(db_name, inc_hands, num_players=max(30, num_hands // 2000),
+                              is_tourney=is_tourney, seed=num_hands + 1)
+        print(f'Running stats ({kind}, {num_hands} hands, {phase})...')
+        (num_new_actions, num_new_hands, elapsed) = time_stats(db_name, is_tourney, verbose)
+        print(f'...{elapsed:.1f} s for {num_new_hands} new hands')
+        result_list.append({'kind': kind, 'db_hands': num_hands, 'phase': phase,
+                            'new_hands': num_new_hands, 'new_actions': num_new_actions,
+                            'seconds': round(elapsed, 3)})
+
+    os.remove(db_name)
+    return result_list
+
+
+def write_results(result_list, out_name, label):
+    '''Appends the benchmark results (result_list) to the CSV file (out_name),
+    with a (label) for this version of stats.py and details of the run.'''
+
+    run_info = {'run_time': time.strftime('%Y-%m-%d %H:%M:%S'), 'label': label,
+                'batch_commit': stats.BATCH_COMMIT, 'chunk_hands': stats.CHUNK_HANDS,
+                'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version}
+    field_list = list(run_info) + ['kind', 'db_hands', 'phase', 'new_hands', 'new_actions', 'seconds']
+
+    new_file = not os.path.exists(out_name)
+    with open(out_name, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=field_list)
+        if new_file:
+            writer.writeheader()
+        for result in result_list:
+            writer.writerow(run_info | result)
+
+    print(f'Appended {len(result_list)} results to {out_name}')
+
+
+# main body
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Times stats.py on generated hand history databases.')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='comma-separated numbers of hands, e.g. 10000,100000,1000000,10000000 '
+                             '(default: 10000,100000)')
+    parser.add_argument('--kinds', default='cash,tourney', help='cash and/or tourney (default: cash,tourney)')
+    parser.add_argument('--inc-pct', type=float, default=1,
+                        help='new hands for the incremental run, as a percent of the size (default: 1)')
+    parser.add_argument('--dir', default='bench', help='directory for generated databases (default: bench)')
+    parser.add_argument('--out', default='benchmark_results.csv',
+                        help='CSV file to append results to (default: benchmark_results.csv)')
+    parser.add_argument('--label', default='', help='label for this version of stats.py, e.g. a commit')
+    parser.add_argument('--regenerate', action='store_true', help='generate new databases even if they exist')
+    parser.add_argument('--verbose', action='store_true', help='show stats.py output')
+    parser.add_argument('--compare', action='store_true',
+                        help='also time the action stats as one UPDATE per column (labeled "per-column")')
+    parser.add_argument('--config', default='config.toml', help='config file (default: config.toml)')
+    args = parser.parse_args()
+
+    stats.load_config(args.config)
+    generate.load_config(args.config)
+    # benchmark databases are never test databases
+    stats.TEST_RUN = False
+
+    os.makedirs(args.dir, exist_ok=True)
+    result_list = []
+    for kind in args.kinds.split(','):
+        for num_hands in [int(size) for size in args.sizes.split(',')]:
+            inc_hands = max(1, int(num_hands * args.inc_pct / 100))
+            result_list += run_benchmark(num_hands, kind == 'tourney', inc_hands, args.dir,
+                                         args.regenerate, args.verbose)
+            print()
+
+            # same hands, with the action stats one column at a time
+            if args.compare:
+                print('Action stats per column:')
+                stats.calc_batch = calc_per_column
+                for result in run_benchmark(num_hands, kind == 'tourney', inc_hands, args.dir,
+                                            False, args.verbose):
+                    result['label'] = f'{args.label} per-column'.strip()
+                    result_list.append(result)
+                stats.calc_batch = grouped_calc_batch
+                print()
+
+    print('******************** Summary ********************')
+    for result in result_list:
+        print(f'{result["kind"]:8} {result["db_hands"]:>9} hands {result["phase"]:12}'
+              f'{result["new_hands"]:>9} new hands {result["seconds"]:>10.1f} s'
+              f'{"  (per column)" if "label" in result else ""}')
+    print()
+
+    write_results(result_list, args.out, args.label)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Script generates a synthetic SQLite database of no limit Texas hold 'em (NLHE) hands in the same format as the
+PokerNow hand history databases created by history.py (Actions, Hands, PlayerHands, TableNames, TourneyActions,
+PlayerNames), so that stats.py can be run and benchmarked without real hand histories.
+Hands are simulated with simple random players, so the stats are plausible but not meaningful.
+Running it again on the same database appends new tables and hands after the existing ones.
+Uses the [const] section of config.toml for the action, street, and position values.
+"""
+
+import argparse  # command line options
+import datetime  # hand times
+import random  # simulated players
+import sqlite3  # sqlite database
+import tomllib  # toml config file
+
+
+# tables are created only if they do not exist, so existing databases are appended to
+SCHEMA_LIST = [
+    '''CREATE TABLE IF NOT EXISTS PlayerNames
+        (player_id INTEGER PRIMARY KEY,
+         first_name TEXT,
+         last_name TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS TableNames
+        (table_id INTEGER PRIMARY KEY,
+         table_name TEXT,
+         time TIMESTAMP(3),
+         sess_num INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS Hands
+        (table_id INTEGER,
+         hand_num INTEGER,
+         time TIMESTAMP(3),
+         bb_amt INTEGER,
+         pf_agg_id INTEGER,
+         flop_agg_id INTEGER,
+         turn_agg_id INTEGER,
+         pf_bet_level INTEGER,
+         UNIQUE(table_id, hand_num))''',
+    '''CREATE TABLE IF NOT EXISTS PlayerHands
+        (table_id INTEGER,
+         hand_num INTEGER,
+         player_id INTEGER,
+         pos INTEGER,
+         stack INTEGER,
+         balance INTEGER,
+         saw_sd BOOLEAN,
+         card1 TEXT,
+         card2 TEXT,
+         own_c1 TEXT,
+         own_c2 TEXT,
+         UNIQUE(table_id, hand_num, player_id))''',
+    '''CREATE TABLE IF NOT EXISTS Actions
+        (table_id INTEGER,
+         hand_num INTEGER,
+         action_num INTEGER,
+         player_id INTEGER,
+         street INTEGER,
+         action_id INTEGER,
+         amount INTEGER,
+         bet_level INTEGER,
+         agg_id INTEGER,
+         prev_act_id INTEGER,
+         n_commit INTEGER,
+         UNIQUE(table_id, hand_num, action_num))''',
+    '''CREATE TABLE IF NOT EXISTS TourneyActions
+        (table_id INTEGER,
+         player_id INTEGER,
+         time TIMESTAMP(3),
+         t_action_id INTEGER,
+         amount INTEGER,
+         sess_num INTEGER,
+         prev_action_id INTEGER)''',
+]
+
+CARD_LIST = [rank + suit for rank in '23456789TJQKA' for suit in 'cdhs']
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.000'
+
+
+def sim_hand(rng, player_list, bb_amt, style):
+    '''Simulates one hand for the players in (player_list), in seat order
+    starting with the button, with big blind (bb_amt).
+    (style) is a dict of action probabilities (see generate).
+    Returns a tuple of (hand row, list of player hand rows, list of action rows),
+    without table_id and hand_num.'''
+
+    num_seats = len(player_list)
+    if num_seats == 2:
+        # heads up: button is the small blind and acts first preflop
+        (sb_index, bb_index) = (0, 1)
+        pf_order = [0, 1]
+    else:
+        (sb_index, bb_index) = (1, 2)
+        pf_order = list(range(3, num_seats)) + [0, 1, 2]
+
+    # button is 1, utg at 10-player table is 8; blinds add BB_VAL/SB_VAL
+    pos_dict = {}
+    for (i, player_id) in enumerate(player_list):
+        if i == sb_index:
+            pos_dict[player_id] = SB_VAL + 1
+        elif i == bb_index:
+            pos_dict[player_id] = BB_VAL + 1
+        elif i == 0:
+            pos_dict[player_id] = POS_MIN
+        else:
+            pos_dict[player_id] = num_seats - i + 1
+
+    stack_dict = {player_id: rng.randint(40, 300) * bb_amt for player_id in player_list}
+    put_dict = {player_id: 0 for player_id in player_list}
+    active_list = list(player_list)
+    action_list = []
+    last_action = {}
+    agg_dict = {}
+
+    def add_action(player_id, street, action_id, amount, bet_level, agg_id, n_commit):
+        action_list.append((len(action_list) + 1, player_id, street, action_id, amount,
+                            bet_level, agg_id, last_action.get(player_id), n_commit))
+        last_action[player_id] = action_id
+
+    # post blinds
+    sb_id = player_list[sb_index]
+    bb_id = player_list[bb_index]
+    add_action(sb_id, PREFLOP_VAL, POST_VAL, bb_amt // 2, 0, None, 0)
+    add_action(bb_id, PREFLOP_VAL, POST_VAL, bb_amt, 0, None, 0)
+    put_dict[sb_id] = bb_amt // 2
+    put_dict[bb_id] = bb_amt
+
+    pf_bet_level = 0
+    for street in (PREFLOP_VAL, FLOP_VAL, TURN_VAL, RIVER_VAL):
+        if len(active_list) < 2:
+            break
+
+        if street == PREFLOP_VAL:
+            order = [player_list[i] for i in pf_order]
+            to_call = bb_amt
+            street_put = dict(put_dict)
+        else:
+            # postflop, the first active player after the button acts first
+            if num_seats > 2:
+                order = player_list[1:] + player_list[:1]
+            else:
+                order = [player_list[1], player_list[0]]
+            order = [player_id for player_id in order if player_id in active_list]
+            to_call = 0
+            street_put = {player_id: 0 for player_id in player_list}
+
+        bet_level = 0
+        agg_id = None
+        n_commit = 0
+        acted_set = set()
+        i = 0
+        while True:
+            live_list = [player_id for player_id in order if player_id in active_list]
+            if len(live_list) < 2:
+                break
+            player_id = order[i % len(order)]
+            i += 1
+            if player_id not in active_list:
+                continue
+            if player_id in acted_set and street_put[player_id] >= to_call:
+                # street is over when everyone has acted and matched the bet
+                if all(p in acted_set and street_put[p] >= to_call for p in live_list):
+                    break
+                continue
+
+            owed = to_call - street_put[player_id]
+            r = rng.random()
+            if bet_level <= 1:
+                raise_prob = style['raise']
+            elif bet_level < 4:
+                raise_prob = style['reraise']
+            else:
+                raise_prob = style['reraise'] / 4
+            if owed <= 0:
+                if street != PREFLOP_VAL and r < style['bet']:
+                    action_id = BET_VAL if bet_level == 0 else RAISE_VAL
+                elif street == PREFLOP_VAL and r < raise_prob:
+                    action_id = RAISE_VAL
+                else:
+                    action_id = CHECK_VAL
+            elif r < raise_prob:
+                action_id = RAISE_VAL
+            elif r < raise_prob + style['call']:
+                action_id = CALL_VAL
+            else:
+                action_id = FOLD_VAL
+
+            if action_id == FOLD_VAL:
+                add_action(player_id, street, action_id, 0, bet_level, agg_id, n_commit)
+                active_list.remove(player_id)
+            elif action_id == CHECK_VAL:
+                add_action(player_id, street, action_id, 0, bet_level, agg_id, n_commit)
+            elif action_id == CALL_VAL:
+                add_action(player_id, street, action_id, owed, bet_level, agg_id, n_commit)
+                street_put[player_id] = to_call
+                n_commit += 1
+                if street == PREFLOP_VAL and bet_level == 0:
+                    # limp
+                    bet_level = 1
+            else:
+                new_to_call = max(to_call * 2, bb_amt * 2) + rng.randint(0, 3) * bb_amt
+                add_action(player_id, street, action_id, new_to_call - street_put[player_id],
+                           bet_level, agg_id, n_commit)
+                street_put[player_id] = new_to_call
+                to_call = new_to_call
+                n_commit += 1
+                agg_id = player_id
+                if street == PREFLOP_VAL:
+                    bet_level = max(bet_level, 1) + 1
+                else:
+                    bet_level += 1
+            acted_set.add(player_id)
+
+        if street == PREFLOP_VAL:
+            pf_bet_level = bet_level
+            put_dict = street_put
+        else:
+            for player_id in player_list:
+                put_dict[player_id] += street_put[player_id]
+        agg_dict[street] = agg_id
+
+    # winners split the pot (occasionally a chop at showdown)
+    pot = sum(put_dict.values())
+    went_sd = len(active_list) >= 2
+    if went_sd and rng.random() < 0.08:
+        winner_list = rng.sample(active_list, 2)
+    else:
+        winner_list = [rng.choice(active_list)]
+    balance_dict = {player_id: -put_dict[player_id] for player_id in player_list}
+    for player_id in winner_list:
+        balance_dict[player_id] += pot // len(winner_list)
+
+    deck = rng.sample(CARD_LIST, 2 * num_seats)
+    player_hand_list = []
+    for (i, player_id) in enumerate(player_list):
+        saw_sd = 1 if went_sd and player_id in active_list else 0
+        if saw_sd or (player_id in winner_list and rng.random() < 0.1):
+            (card1, card2) = (deck[2 * i], deck[2 * i + 1])
+        else:
+            (card1, card2) = (None, None)
+        player_hand_list.append((player_id, pos_dict[player_id], stack_dict[player_id],
+                                 balance_dict[player_id], saw_sd, card1, card2, None, None))
+
+    hand = (agg_dict.get(PREFLOP_VAL), agg_dict.get(FLOP_VAL), agg_dict.get(TURN_VAL), pf_bet_level)
+    return (hand, player_hand_list, action_list)
+
+
+def generate(db_name, num_hands=2000, num_players=30, table_size=(2, 9), hands_per_table=200,
+             is_tourney=False, bb_amt=20, style=None, seed=1, start_time='2022-01-03 19:00:00'):
+    '''Adds (num_hands) simulated hands to database (db_name), creating the
+    tables if needed. Each table (session) seats a random number of players
+    between the (table_size) tuple from a pool of (num_players) players and
+    plays up to (hands_per_table) hands, with 1-7 days between tables.
+    New tables and hands continue after any existing ones; otherwise the first
+    table begins at (start_time).
+    Optional boolean (is_tourney) adds buy-ins and busts to TourneyActions.
+    Optional dict (style) sets the probabilities of each action, which also
+    sets how often hands reach each street:
+     'raise': open or raise when the pot is raised at most once
+     'reraise': raise when the pot has already been raised
+     'call': call a bet
+     'bet': bet or raise postflop when checked to
+    Returns the number of hands added.'''
+
+    rng = random.Random(seed)
+    if style is None:
+        style = {}
+    style = {'raise': 0.22, 'reraise': 0.12, 'call': 0.4, 'bet': 0.35} | style
+
+    with sqlite3.connect(db_name) as conn:
+        cur = conn.cursor()
+        for query in SCHEMA_LIST:
+            cur.execute(query)
+
+        names = [(i, f'First{i}', f'Last{i}') for i in range(1, num_players + 1)]
+        cur.executemany('INSERT OR IGNORE INTO PlayerNames VALUES (?, ?, ?)', names)
+
+        # continue after the existing tables and hands
+        cur.execute('SELECT MAX(table_id) FROM TableNames')
+        (table_id,) = cur.fetchone()
+        table_id = (table_id or 0) + 1
+        cur.execute('SELECT MAX(time) FROM Hands')
+        (last_time,) = cur.fetchone()
+        if last_time is None:
+            hand_time = datetime.datetime.fromisoformat(start_time)
+        else:
+            hand_time = datetime.datetime.fromisoformat(last_time) + datetime.timedelta(days=1)
+
+        num_added = 0
+        while num_added < num_hands:
+            seat_list = rng.sample(range(1, num_players + 1), min(rng.randint(*table_size), num_players))
+            query = 'INSERT INTO TableNames (table_id, table_name, time) VALUES (?, ?, ?)'
+            cur.execute(query, (table_id, f'table{table_id}', hand_time.strftime(TIME_FORMAT)))
+
+            query = '''INSERT INTO TourneyActions (table_id, player_id, time, t_action_id, amount)
+                VALUES (?, ?, ?, ?, ?)'''
+            if is_tourney:
+                cur.executemany(query, [(table_id, player_id, hand_time.strftime(TIME_FORMAT), BUYIN_VAL,
+                                         1000) for player_id in seat_list])
+
+            button = 0
+            hand_num = 1
+            while hand_num <= hands_per_table and num_added < num_hands and len(seat_list) >= 2:
+                hand_time += datetime.timedelta(seconds=rng.randint(30, 150))
+                time_str = hand_time.strftime(TIME_FORMAT)
+                player_list = seat_list[button:] + seat_list[:button]
+                button = (button + 1) % len(seat_list)
+
+                (hand, player_hand_list, action_list) = sim_hand(rng, player_list, bb_amt, style)
+                cur.execute('INSERT INTO Hands VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (table_id, hand_num, time_str, bb_amt) + hand)
+                cur.executemany('INSERT INTO PlayerHands VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(table_id, hand_num) + row for row in player_hand_list])
+                cur.executemany('INSERT INTO Actions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(table_id, hand_num) + row for row in action_list])
+
+                # tournament players occasionally bust
+                if is_tourney and len(seat_list) > 2 and rng.random() < 0.03:
+                    player_id = rng.choice(seat_list)
+                    seat_list.remove(player_id)
+                    button %= len(seat_list)
+                    cur.execute(query, (table_id, player_id, time_str, QUIT_VAL, 0))
+
+                hand_num += 1
+                num_added += 1
+
+            table_id += 1
+            hand_time += datetime.timedelta(days=rng.choice([1, 2, 3, 7]))
+
+        conn.commit()
+        cur.close()
+    conn.close()
+
+    return num_added
+
+
+def load_config(config_name='config.toml'):
+    '''Loads the [const] section of the config file (config_name) into
+    the global constants, as in stats.py.'''
+
+    global POST_VAL, FOLD_VAL, CHECK_VAL, CALL_VAL, BET_VAL, RAISE_VAL, QUIT_VAL, BUYIN_VAL, \
+           PREFLOP_VAL, FLOP_VAL, TURN_VAL, RIVER_VAL, BB_VAL, SB_VAL, POS_MIN
+
+    # import config file
+    with open(config_name, mode='rb') as f:
+        config = tomllib.load(f)
+
+    POST_VAL = config['const']['POST_VAL']
+    FOLD_VAL = config['const']['FOLD_VAL']
+    CHECK_VAL = config['const']['CHECK_VAL']
+    CALL_VAL = config['const']['CALL_VAL']
+    BET_VAL = config['const']['BET_VAL']
+    RAISE_VAL = config['const']['RAISE_VAL']
+    QUIT_VAL = config['const']['QUIT_VAL']
+    BUYIN_VAL = config['const']['BUYIN_VAL']
+    PREFLOP_VAL = config['const']['PREFLOP_VAL']
+    FLOP_VAL = config['const']['FLOP_VAL']
+    TURN_VAL = config['const']['TURN_VAL']
+    RIVER_VAL = config['const']['RIVER_VAL']
+    BB_VAL = config['const']['BB_VAL']
+    SB_VAL = config['const']['SB_VAL']
+    POS_MIN = config['const']['POS_MIN']
+
+
+# main body
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generates a synthetic hand history database for stats.py.')
+    parser.add_argument('db_name', help='database to create or append to, e.g. hh_demo.sqlite')
+    parser.add_argument('--hands', type=int, default=5000, help='number of hands to add (default: 5000)')
+    parser.add_argument('--players', type=int, default=30, help='number of players in the pool (default: 30)')
+    parser.add_argument('--min-seats', type=int, default=2, help='fewest players at a table (default: 2)')
+    parser.add_argument('--max-seats', type=int, default=9, help='most players at a table (default: 9)')
+    parser.add_argument('--table-hands', type=int, default=200, help='hands per table (default: 200)')
+    parser.add_argument('--tourney', action='store_true', help='add tournament buy-ins and busts')
+    parser.add_argument('--raise', type=float, default=0.22, dest='raise_prob',
+                        help='probability to open or raise an unraised/once-raised pot (default: 0.22)')
+    parser.add_argument('--reraise', type=float, default=0.12,
+                        help='probability to raise an already-raised pot (default: 0.12)')
+    parser.add_argument('--call', type=float, default=0.4, help='probability to call a bet (default: 0.4)')
+    parser.add_argument('--bet', type=float, default=0.35,
+                        help='probability to bet postflop when checked to (default: 0.35)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+    parser.add_argument('--config', default='config.toml', help='config file (default: config.toml)')
+    args = parser.parse_args()
+
+    load_config(args.config)
+    style = {'raise': args.raise_prob, 'reraise': args.reraise, 'call': args.call, 'bet': args.bet}
+    num_added = generate(args.db_name, args.hands, args.players, (args.min_seats, args.max_seats),
+                         args.table_hands, args.tourney, style=style, seed=args.seed)
+    print(f'Added {num_added} hands to {args.db_name}')
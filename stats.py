@@ -13,10 +13,6 @@ Uses config.toml for configuration.
 
 """
 Wish list (XXX):
--Calculate only new columns (instead of resetting entire db):
-    1. Add boolean variable in calc methods to use NewActions vs Actions
-    2. Use conditional ALTER TABLE for new columns
-    -set boolean variable (e.g. list of column names) here
 -Remove duplicate sess_num columns?
 -Won w/o SD % is sometimes negative in Tableau: (COUNT([Wwsf])-COUNT([Won Sd]))/COUNT([N Wwsf])
 ...Likely related to how wwsf/n_wwsf only counts when players take an action on flop, not when they are active
@@ -30,15 +26,30 @@ Wish list (XXX):
 """
 
 import sqlite3  # sqlite database
-import shutil  # file copy
+import os  # small db files
 import tomllib  # toml config file
 import time  # pause
+import contextlib  # savepoint context manager
+import argparse  # command line options
+import multiprocessing  # parallel databases
+import sys  # output prefixes
+import json  # profile reports
+import csv  # profile reports
+import itertools  # export partitions
+import shutil  # export files
+import tempfile  # shard files
+import pathlib  # read-only database URI
+
+# number of stat groups run since the last commit in batch mode
+groups_since_commit = 0
+
+# timing of each stats query for the current database when profiling (see execute_query)
+query_log = []
 
 
 def try_query(cur, query, values=None):
     '''Tries to execute query and catches exception if it fails.
-    Useful for hacky equivalent to ALTER TABLE IF NOT EXISTS
-    and for troubleshooting pesky DB errors.'''
+    Useful for troubleshooting pesky DB errors.'''
     
     try:
         if values:
@@ -61,6 +72,189 @@ def try_query(cur, query, values=None):
 
     return err
 
+
+def execute_query(cur, query, values=None, label=''):
+    '''Executes a stats query (query) with optional (values).
+    Optional (label) names the stat(s) calculated by the query.
+    If EXPLAIN_PLAN is set in config.toml, first runs EXPLAIN QUERY PLAN
+    on the query and reports any full table scans of database tables
+    (scans of temporary tables like NewActions and of subqueries are expected).
+    If PROFILE is set, records the time, rows changed, SQL, and optionally
+    the query plan in query_log (see write_profile).'''
+
+    if values is None:
+        values = ()
+
+    plan_list = []
+    if EXPLAIN_PLAN or (PROFILE and PROFILE_PLAN):
+        # row is (id, parent, notused, detail), e.g. 'SCAN Hands USING INDEX blah'
+        plan_list = [row[3] for row in cur.execute(f'EXPLAIN QUERY PLAN {query}', values).fetchall()]
+
+    if EXPLAIN_PLAN:
+        query_plan = 'SELECT name FROM sqlite_master WHERE type = \'table\''
+        table_set = {row[0] for row in cur.execute(query_plan).fetchall()}
+        scan_list = []
+        for detail in plan_list:
+            if detail.startswith('SCAN ') and detail.split()[1] in table_set:
+                scan_list.append(detail)
+        if scan_list:
+            print()
+            print(f'...Full table scan ({", ".join(scan_list)}): {" ".join(query.split())[:200]}')
+
+    if not PROFILE:
+        return cur.execute(query, values)
+
+    begin_time = time.perf_counter()
+    cur.execute(query, values)
+    query_log.append({'label': label,
+                      'seconds': round(time.perf_counter() - begin_time, 6),
+                      'rows': cur.rowcount,
+                      'sql': ' '.join(query.split()),
+                      'plan': ' | '.join(plan_list)})
+    return cur
+
+
+def write_profile(query_list, out_name):
+    '''Writes the profiled queries (query_list, see execute_query) to a report
+    in PROFILE_DIR named (out_name), as JSON or CSV (PROFILE_FORMAT).'''
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    out_path = os.path.join(PROFILE_DIR, f'{out_name}.{PROFILE_FORMAT}')
+
+    if PROFILE_FORMAT == 'csv':
+        field_list = ['db_name', 'label', 'seconds', 'rows', 'sql', 'plan']
+        with open(out_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=field_list)
+            writer.writeheader()
+            writer.writerows(query_list)
+    else:
+        with open(out_path, 'w') as f:
+            json.dump(query_list, f, indent=1)
+
+    print(f'Wrote profile of {len(query_list)} queries to {out_path}')
+
+
+def commit_stats(conn):
+    '''Commits after a stats query, unless BATCH_COMMIT is set in config.toml;
+    in batch mode, stat_group() decides when to commit instead.'''
+
+    if not BATCH_COMMIT:
+        conn.commit()
+
+
+@contextlib.contextmanager
+def stat_group(conn, group_name):
+    '''Context manager for running a group of stats (group_name).
+    In batch mode (BATCH_COMMIT), the group runs inside a SAVEPOINT so that
+    a failed group is rolled back on its own, and the transaction is
+    committed after every BATCH_GROUPS groups (0 = once per database).'''
+
+    global groups_since_commit
+
+    if not BATCH_COMMIT:
+        yield
+        return
+
+    conn.execute(f'SAVEPOINT {group_name}')
+    try:
+        yield
+    except Exception:
+        conn.execute(f'ROLLBACK TO {group_name}')
+        conn.execute(f'RELEASE {group_name}')
+        raise
+    conn.execute(f'RELEASE {group_name}')
+
+    groups_since_commit += 1
+    if BATCH_GROUPS > 0 and groups_since_commit >= BATCH_GROUPS:
+        conn.commit()
+        groups_since_commit = 0
+
+
+def set_run_pragmas(conn):
+    '''Sets pragmas tuned for a batch mode stats run and returns
+    the previous values, to be restored with restore_pragmas().
+    Must be called before creating NewActions, because changing temp_store
+    deletes all temporary tables.'''
+
+    pragma_dict = {'journal_mode': BATCH_JOURNAL_MODE,
+                   'synchronous': 'NORMAL',
+                   'temp_store': 'MEMORY',
+                   'cache_size': BATCH_CACHE_SIZE}
+    old_dict = {}
+
+    global groups_since_commit
+    groups_since_commit = 0
+
+    cur = conn.cursor()
+    conn.commit()  # journal_mode can't change inside a transaction
+    for (pragma, value) in pragma_dict.items():
+        old_dict[pragma] = cur.execute(f'PRAGMA {pragma}').fetchone()[0]
+        cur.execute(f'PRAGMA {pragma} = {value}')
+    cur.close()
+
+    return old_dict
+
+
+def restore_pragmas(conn, old_dict):
+    '''Commits and restores the pragmas (old_dict) returned by set_run_pragmas().'''
+
+    cur = conn.cursor()
+    conn.commit()
+    for (pragma, value) in old_dict.items():
+        cur.execute(f'PRAGMA {pragma} = {value}')
+    cur.close()
+
+
+def create_indexes(conn):
+    '''Creates covering indexes for the stats queries, unless the table
+    is missing or already has an index that starts with the same columns
+    (e.g., from a UNIQUE constraint or from history.py).'''
+
+    index_list = [('Actions', ('table_id', 'hand_num', 'street', 'action_num')),
+                  ('Hands', ('table_id', 'hand_num')),
+                  ('Hands', ('time',)),
+                  ('PlayerHands', ('table_id', 'hand_num', 'player_id')),
+                  ('TableNames', ('time',)),
+                  ('TourneyActions', ('sess_num', 'player_id', 'time')),
+                  ('StatTourneyHands', ('sess_num', 'sess_hand')),
+                  ('StatPlayerHands', ('date_added',)),
+                  ('StatPlayerHands', ('row_num',)),
+                  ('StatPlayerHands', ('player_id', 'row_num'))]
+
+    cur = conn.cursor()
+
+    print('Checking indexes...')
+
+    # action codes are not looked up by index, and each index slows every update
+    for street_name in ['pf', 'flop', 'turn', 'river']:
+        cur.execute(f'DROP INDEX IF EXISTS idx_StatPlayerHands_act_{street_name}')
+
+    for (table_name, col_tuple) in index_list:
+        query = '''SELECT name FROM sqlite_master
+                WHERE type = 'table' AND name = ?'''
+        if cur.execute(query, (table_name,)).fetchone() is None:
+            continue
+
+        # look for an existing index with the same leading columns
+        found = False
+        for index_row in cur.execute(f'PRAGMA index_list({table_name})').fetchall():
+            index_name = index_row[1]
+            index_cols = tuple(row[2] for row in
+                               cur.execute(f'PRAGMA index_info({index_name})').fetchall())
+            if index_cols[:len(col_tuple)] == col_tuple:
+                found = True
+                break
+
+        if not found:
+            index_name = f'idx_{table_name}_{"_".join(col_tuple)}'
+            print(f'...Creating index {index_name}')
+            query = f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({", ".join(col_tuple)})'
+            cur.execute(query)
+
+    conn.commit()
+    cur.close()
+
+
 def calc_action(conn, stat_name, stat_cond, stat_cond2='',
                 val='1', join_hands=False, join_p_hands=False):
     '''General DB query for single actions.
@@ -108,58 +302,343 @@ def calc_action(conn, stat_name, stat_cond, stat_cond2='',
              + f'{cond_str}')
     print(stat_name, end=' ')
     # print(query)
-    cur.execute(query)
+    execute_query(cur, query, label=stat_name)
             
-    conn.commit()
+    commit_stats(conn)
+    cur.close()
+
+
+def join_string(join):
+    '''Returns the JOIN clause for a stat registry (join) value:
+    None, 'hands' for Hands, or 'p_hands' for PlayerHands.'''
+
+    if join == 'hands':
+        return 'JOIN Hands USING (table_id, hand_num) '
+    elif join == 'p_hands':
+        return 'JOIN PlayerHands USING (table_id, hand_num, player_id) '
+    else:
+        return ''
+
+
+def update_stats(conn, set_list, subquery, label='', row_cond=''):
+    '''Sets several StatPlayerHands columns at once from the results of
+    a subquery (subquery) that returns table_id, hand_num, player_id,
+    and one column per stat.
+    (set_list) is a list of "col = value" strings, using <sq.col> for the
+    subquery columns. Optional (label) names the stats for profiling.
+    Optional (row_cond) only updates the rows that match it.'''
+
+    cur = conn.cursor()
+    query = ('UPDATE StatPlayerHands'
+             + f' SET {", ".join(set_list)}'
+             + f' FROM ({subquery}) AS sq'
+             + ' WHERE StatPlayerHands.table_id = sq.table_id'
+             + ' AND StatPlayerHands.hand_num = sq.hand_num'
+             + ' AND StatPlayerHands.player_id = sq.player_id')
+    if row_cond:
+        query += f' AND ({row_cond})'
+    # print(query)
+    execute_query(cur, query, label=label)
+
+    commit_stats(conn)
     cur.close()
 
 
-def calc_seq_action(conn, stat_name, stat_cond, same_player=True, join_hands=False):
-    '''General DB query for sequential actions on same street.
-    Fills in boolean values for a stat column (stat_name)
-    that matches (stat_cond).
-    In (stat_cond), use <a1.x> and <a2.x> for action1 and action2, respectively.
-    Use (same_player) flag for same/different players for action1 and action2.
-    If optional (join_hands) is set to true, JOINS Hands table for hand info.'''
+def calc_batch(conn, stat_list, join=None):
+    '''Batch version of calc_action() for a list of stats (stat_list)
+    from the stat registry that all use the same (join).
+    Instead of one UPDATE per stat, all of the stats are calculated in one
+    grouped pass over NewActions (one conditional aggregate per column)
+    and written with one UPDATE. Also runs 'derived' stats, which are
+    single actions with (stat_cond) 'True' and (stat_cond2) (cond).'''
 
     '''
     The general form of the subquery is
-     SELECT table_id, hand_num, a2.player_id
-     FROM NewActions a1 JOIN NewActions a2 USING (blah)
-     [JOIN Hands USING (blah)]
-     WHERE a1.action_num < a2.action_num [AND a1.player_id = a2.player_id]
-     AND conditions
-    The general form of the query is the same as calc_action
+     SELECT table_id, hand_num, player_id,
+      MAX(CASE WHEN cond1 THEN 1 END) AS stat1,
+      MAX(CASE WHEN cond2 THEN 1 END) AS stat2, ...
+     FROM NewActions [JOIN Hands/PlayerHands USING (blah)]
+     WHERE cond1 OR cond2 ...
+     GROUP BY table_id, hand_num, player_id
+    The general form of the query is
+     UPDATE StatPlayerHands
+     SET stat1 = CASE WHEN sq.stat1 = 1 [AND stat_cond2] THEN val ELSE stat1 END,
+     ...
+     FROM (subquery) AS sq
+     WHERE StatPlayerHands.id = sq.id
+     [AND ((sq.stat1 = 1 AND stat_cond2) OR sq.stat2 = 1 ...)]
     '''
-    
-    # same or different player for action1 and action2
-    if same_player:
-        player_str = 'AND a1.player_id = a2.player_id '
+
+    select_str = ''
+    set_list = []
+    cond_list = []
+    row_list = []
+    for stat in stat_list:
+        stat_name = stat['name']
+        if stat['kind'] == 'derived':
+            stat_cond = 'True'
+            stat_cond2 = stat['cond']
+        else:
+            stat_cond = stat['cond']
+            stat_cond2 = stat['cond2']
+
+        # Optional stat_cond2 checks previous boolean values
+        if stat_cond2:
+            cond_str = f' AND ({stat_cond2})'
+        else:
+            cond_str = ''
+
+        select_str += f', MAX(CASE WHEN ({stat_cond}) THEN 1 END) AS {stat_name}'
+        set_list.append(f'{stat_name} = CASE WHEN sq.{stat_name} = 1{cond_str}'
+                        + f' THEN {stat["val"]} ELSE StatPlayerHands.{stat_name} END')
+        cond_list.append(f'({stat_cond})')
+        row_list.append(f'(sq.{stat_name} = 1{cond_str})')
+        print(stat_name, end=' ')
+
+    # with (stat_cond2), e.g. derived stats, most rows would be set to their old values
+    if any(stat['cond2'] or stat['kind'] == 'derived' for stat in stat_list):
+        row_cond = ' OR '.join(row_list)
     else:
-        player_str = ''
-    
-    # optional JOIN to Hands table for hand info
-    if join_hands:
-        join_str = 'JOIN Hands USING (table_id, hand_num) '
+        row_cond = ''
+
+    subquery = (f'SELECT table_id, hand_num, player_id{select_str}'
+                + f' FROM NewActions {join_string(join)}'
+                + f'WHERE {" OR ".join(cond_list)}'
+                + ' GROUP BY table_id, hand_num, player_id')
+    update_stats(conn, set_list, subquery, label=' '.join(stat['name'] for stat in stat_list),
+                 row_cond=row_cond)
+
+
+def calc_seq_batch(conn, stat_list, street=None):
+    '''Calculates the sequential stats (stat_list) from the stat registry:
+    actions that match (stat_cond) after an earlier action on the same street
+    that matches (first_cond).
+    Instead of joining NewActions to itself, a running MAX() over the earlier
+    actions on the same street (in action_num order) flags whether any of
+    them matched (first_cond), so that every sequential stat comes out of
+    one ordered pass over NewActions.
+    Only the actions that match one of the conditions are windowed, and
+    optional (street) limits them to the actions on that street.'''
+
+    '''
+    The general form of the subquery is
+     SELECT table_id, hand_num, player_id,
+      MAX(CASE WHEN then1 = 1 AND first1 = 1 THEN 1 END) AS stat1, ...
+     FROM
+      (SELECT table_id, hand_num, player_id,
+        CASE WHEN cond1 THEN 1 END AS then1,
+        MAX(CASE WHEN first_cond1 THEN 1 END) OVER street_win AS first1, ...
+       FROM NewActions [JOIN Hands/PlayerHands USING (blah)]
+       WHERE [street = blah AND] (cond1 OR first_cond1 OR ...)
+       WINDOW street_win AS (PARTITION BY table_id, hand_num[, street]
+        [, player_id] ORDER BY action_num
+        RANGE BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING))
+     WHERE (then1 = 1 AND first1 = 1) OR ...
+     GROUP BY table_id, hand_num, player_id
+    The general form of the query is the same as calc_batch
+    '''
+
+    select_str = ''
+    inner_str = ''
+    set_list = []
+    cond_list = []
+    filter_list = []
+    first_dict = {}
+    join_set = set()
+    for stat in stat_list:
+        stat_name = stat['name']
+
+        # same or different player for action1 and action2
+        if stat['same_player']:
+            window = 'player_win'
+        else:
+            window = 'street_win'
+
+        # stats with the same earlier action share one running MAX()
+        first_key = (stat['first_cond'], window)
+        if first_key not in first_dict:
+            first_dict[first_key] = f'first_{len(first_dict)}'
+            inner_str += (f', MAX(CASE WHEN ({stat["first_cond"]}) THEN 1 END)'
+                          + f' OVER {window} AS {first_dict[first_key]}')
+            filter_list.append(f'({stat["first_cond"]})')
+        first_name = first_dict[first_key]
+
+        inner_str += f', CASE WHEN ({stat["cond"]}) THEN 1 END AS then_{stat_name}'
+        select_str += (f', MAX(CASE WHEN then_{stat_name} = 1'
+                       + f' AND {first_name} = 1 THEN 1 END) AS {stat_name}')
+        set_list.append(f'{stat_name} = CASE WHEN sq.{stat_name} = 1'
+                        + f' THEN 1 ELSE StatPlayerHands.{stat_name} END')
+        # rows where no stat is set wouldn't change StatPlayerHands
+        cond_list.append(f'(then_{stat_name} = 1 AND {first_name} = 1)')
+        filter_list.append(f'({stat["cond"]})')
+        join_set.add(stat['join'])
+        print(stat_name, end=' ')
+
+    # actions that match neither condition don't change the running MAX()
+    # (RANGE frames are by action_num, so leaving them out doesn't move the frame)
+    filter_str = f'WHERE ({" OR ".join(filter_list)})'
+    if street is None:
+        partition_str = 'table_id, hand_num, street'
     else:
-        join_str = ''
+        filter_str += f' AND street = {street}'
+        partition_str = 'table_id, hand_num'
+
+    # only earlier actions (a1.action_num < a2.action_num)
+    frame_str = 'ORDER BY action_num RANGE BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING'
+    subquery = (f'SELECT table_id, hand_num, player_id{select_str}'
+                + f' FROM (SELECT table_id, hand_num, player_id{inner_str}'
+                + ' FROM NewActions '
+                + join_string('hands' if 'hands' in join_set else None)
+                + join_string('p_hands' if 'p_hands' in join_set else None)
+                + f'{filter_str}'
+                + f' WINDOW street_win AS (PARTITION BY {partition_str} {frame_str}),'
+                + f' player_win AS (PARTITION BY {partition_str}, player_id {frame_str}))'
+                + f' WHERE {" OR ".join(cond_list)}'
+                + ' GROUP BY table_id, hand_num, player_id')
+    update_stats(conn, set_list, subquery, label=' '.join(stat['name'] for stat in stat_list))
+
+
+def count_batch(conn, stat_list):
+    '''Calculates the counting stats (stat_list) from the stat registry: the number
+    of actions that match each (stat_cond). All of the actions are counted in one pass.'''
+
+    select_str = ''
+    set_list = []
+    cond_list = []
+    for stat in stat_list:
+        stat_name = stat['name']
+        select_str += f', COUNT(CASE WHEN ({stat["cond"]}) THEN 1 END) AS {stat_name}'
+        # players with no matching actions keep the column default
+        set_list.append(f'{stat_name} = CASE WHEN sq.{stat_name} > 0'
+                        + f' THEN sq.{stat_name} ELSE StatPlayerHands.{stat_name} END')
+        cond_list.append(f'({stat["cond"]})')
+        print(stat_name, end=' ')
+
+    subquery = (f'SELECT table_id, hand_num, player_id{select_str}'
+                + ' FROM NewActions JOIN Hands USING (table_id, hand_num)'
+                + f' WHERE {" OR ".join(cond_list)}'
+                + ' GROUP BY table_id, hand_num, player_id')
+    update_stats(conn, set_list, subquery, label=' '.join(stat['name'] for stat in stat_list))
 
-    cur = conn.cursor()
-    query = ('UPDATE StatPlayerHands '
-             + f'SET {stat_name} = 1 '
-             + 'WHERE (table_id, hand_num, player_id) IN '
-             + '(SELECT table_id, hand_num, a2.player_id '
-             + 'FROM NewActions a1 JOIN NewActions a2 '
-             + 'USING (table_id, hand_num, street) '
-             + f'{join_str}'
-             + f'WHERE a1.action_num < a2.action_num {player_str}'
-             + f'AND {stat_cond})')
-    print(stat_name, end=' ')
-    # print(query)
-    cur.execute(query)
-            
-    conn.commit()
-    cur.close()
+
+def code_batch(conn, stat_list):
+    '''Calculates the action code stats (stat_list) from the stat registry in one
+    ordered pass over NewActions. For the actions that match each stat's (stat_cond),
+    e.g. one street, the player's actions are written as a string of one letter per
+    action in action_num order: F(old), X (check), C(all), B(et), or R(aise).
+    Posts are left out, so a player with no other actions keeps NULL.'''
+
+    '''
+    The general form of the subquery is
+     SELECT table_id, hand_num, player_id,
+      MAX(CASE WHEN cond1 THEN codes END) AS stat1, ...
+     FROM
+      (SELECT table_id, hand_num, player_id, street,
+        GROUP_CONCAT(<letter for action_id>, '') OVER (PARTITION BY table_id, hand_num,
+         player_id, street ORDER BY action_num <all rows>) AS codes
+       FROM NewActions
+       WHERE action_id >= FOLD_VAL)
+     WHERE cond1 OR ...
+     GROUP BY table_id, hand_num, player_id
+    The general form of the query is the same as calc_batch
+    '''
+
+    code_list = [(FOLD_VAL, 'F'), (CHECK_VAL, 'X'), (CALL_VAL, 'C'), (BET_VAL, 'B'), (RAISE_VAL, 'R')]
+    code_str = 'CASE action_id ' + ' '.join([f"WHEN {action_id} THEN '{code}'"
+                                             for (action_id, code) in code_list]) + ' END'
+
+    select_str = ''
+    set_list = []
+    cond_list = []
+    for stat in stat_list:
+        stat_name = stat['name']
+        select_str += f', MAX(CASE WHEN ({stat["cond"]}) THEN codes END) AS {stat_name}'
+        set_list.append(f'{stat_name} = CASE WHEN sq.{stat_name} IS NOT NULL'
+                        + f' THEN sq.{stat_name} ELSE StatPlayerHands.{stat_name} END')
+        cond_list.append(f'({stat["cond"]})')
+        print(stat_name, end=' ')
+
+    subquery = (f'SELECT table_id, hand_num, player_id{select_str}'
+                + f' FROM (SELECT table_id, hand_num, player_id, street, GROUP_CONCAT({code_str}, \'\')'
+                + ' OVER (PARTITION BY table_id, hand_num, player_id, street ORDER BY action_num'
+                + ' ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS codes'
+                + f' FROM NewActions WHERE action_id >= {FOLD_VAL})'
+                + f' WHERE {" OR ".join(cond_list)}'
+                + ' GROUP BY table_id, hand_num, player_id')
+    update_stats(conn, set_list, subquery, label=' '.join(stat['name'] for stat in stat_list))
+
+
+def add_stat(registry, stat_name, kind, stat_cond, stat_cond2='', val='1',
+             join=None, first_cond='', same_player=True, street=None, deps=()):
+    '''Adds a stat definition to the stat registry (a list of dicts) for
+    a StatPlayerHands column (stat_name). The kind of stat (kind) is one of:
+     'action': single actions that match (stat_cond); see calc_action()
+     'seq': action that matches (stat_cond) after an earlier action on the
+      same street that matches (first_cond); see calc_seq_batch()
+     'count': number of actions that match (stat_cond); see count_batch()
+     'value': value (val) from subquery (stat_cond); see set_value()
+     'codes': string of the player's actions that match (stat_cond); see code_batch()
+     'derived': rows where other StatPlayerHands columns match (stat_cond)
+    Optional (stat_cond2) checks previous boolean values, as in calc_action().
+    Optional (join) is 'hands' or 'p_hands' to JOIN Hands/PlayerHands table.
+    Optional (same_player) is used by 'seq' stats for same/different players
+    for the earlier and later actions.
+    Optional (street) is used by 'seq' stats whose actions are all on one street.
+    Optional list (deps) names the columns that must be calculated first.'''
+
+    registry.append({'name': stat_name, 'kind': kind, 'cond': stat_cond,
+                     'cond2': stat_cond2, 'val': val, 'join': join,
+                     'first_cond': first_cond, 'same_player': same_player,
+                     'street': street, 'deps': list(deps)})
+    return registry
+
+
+def run_stat_registry(conn, registry, skip=()):
+    '''Runs the stats in the stat registry (registry) in dependency order.
+    Stats whose dependencies have been calculated are grouped by the shape of
+    their query (kind and JOIN) and each group is run as one query.
+    Optional list (skip) names stats that should not be calculated.
+    Dependencies that are not in the registry are assumed to be up to date.'''
+
+    pending = [stat for stat in registry if stat['name'] not in skip]
+    while pending:
+        pending_names = {stat['name'] for stat in pending}
+        ready = [stat for stat in pending if not pending_names.intersection(stat['deps'])]
+        if not ready:
+            raise ValueError(f'Circular stat dependencies: {sorted(pending_names)}')
+
+        # group stats that can share a query
+        shape_groups = {}
+        for stat in ready:
+            if stat['kind'] in ('action', 'derived'):
+                shape = ('action', stat['join'])
+            elif stat['kind'] == 'seq':
+                shape = ('seq', stat['street'])
+            elif stat['kind'] == 'count':
+                shape = ('count',)
+            elif stat['kind'] == 'codes':
+                shape = ('codes',)
+            elif stat['kind'] == 'value':
+                shape = ('value', stat['name'])
+            else:
+                raise ValueError(f'Unknown kind of stat: {stat["kind"]} ({stat["name"]})')
+            shape_groups.setdefault(shape, []).append(stat)
+
+        for shape, stat_list in shape_groups.items():
+            with stat_group(conn, f'stats_{shape[0]}'):
+                if shape[0] == 'action':
+                    calc_batch(conn, stat_list, join=shape[1])
+                elif shape[0] == 'seq':
+                    calc_seq_batch(conn, stat_list, street=shape[1])
+                elif shape[0] == 'count':
+                    count_batch(conn, stat_list)
+                elif shape[0] == 'codes':
+                    code_batch(conn, stat_list)
+                else:
+                    for stat in stat_list:
+                        set_value(conn, stat['name'], stat['val'], stat['cond'])
+
+        pending = [stat for stat in pending if stat not in ready]
 
 
 def set_value(conn, col, val, subq, values=None,
@@ -209,48 +688,9 @@ def set_value(conn, col, val, subq, values=None,
     
     print(col, end=' ')
     # print(query)
-    if values is None:
-        cur.execute(query)
-    else:
-        cur.execute(query, values)
+    execute_query(cur, query, values, label=col)
     
-    conn.commit()
-    cur.close()
-
-
-def count_action(conn, stat_name, stat_cond):
-    '''General DB query for counting number of actions taken by player in a hand.
-    Fills in count values for a column (stat_name) that matches (stat_cond).'''
-    
-    '''I actually came up with this before set_value() and didn't realize that
-    it has the same general query form. Could actually call set_value() with
-    the counting subquery as the (subq) argument.'''
-
-    '''
-    The general form of the subquery is
-     SELECT table_id, hand_num, player_id, COUNT(*) num_actions
-     FROM NewActions JOIN Hands USING (blah)
-     WHERE conditions
-     GROUP BY table_id, hand_num, player_id
-    The general form of the query is the same as set_value
-    '''
-
-    cur = conn.cursor()
-    subquery = ('SELECT table_id, hand_num, player_id, COUNT(*) num_actions'
-                + ' FROM NewActions JOIN Hands USING (table_id, hand_num)'
-                + f' WHERE {stat_cond}'
-                + ' GROUP BY table_id, hand_num, player_id')
-    query = ('UPDATE StatPlayerHands'
-             + f' SET {stat_name} = sq.num_actions'
-             + f' FROM ({subquery}) AS sq'
-             + ' WHERE StatPlayerHands.table_id = sq.table_id'
-             + ' AND StatPlayerHands.hand_num = sq.hand_num'
-             + ' AND StatPlayerHands.player_id = sq.player_id')
-    print(stat_name, end=' ')
-    # print(query)
-    cur.execute(query)
-            
-    conn.commit()
+    commit_stats(conn)
     cur.close()
 
 
@@ -328,24 +768,110 @@ def split_sessions(conn, num_days=0, num_sessions=0, return_all=False):
     return begin_time
 
 
-def create_stats_table_sparse(conn, db_name, clear_db):
+def set_sessions(conn):
+    '''Sets TableNames.sess_num in one pass over Hands
+    (sessions defined by >= TIME_DIFF days between hands, oldest is 1).
+    Sessions that end before the earliest new hand keep their numbers;
+    new hands extend the last of those sessions or start new ones.'''
+
+    '''
+    The general form of the query is
+     WITH Gaps AS (SELECT time, time - LAG(time) AS time_diff FROM Hands
+                   WHERE time >= last hand before anchor),
+      HandSessions AS (SELECT time, anchor_sess + running SUM(new session flag) AS sess_num
+                       FROM Gaps),
+      Sessions AS (SELECT sess_num, MIN(time) AS begin_time, LEAD(MIN(time)) AS end_time
+                   FROM HandSessions GROUP BY sess_num)
+     UPDATE TableNames
+     SET sess_num = Sessions.sess_num
+     FROM Sessions
+     WHERE TableNames.time >= anchor AND TableNames.time BETWEEN begin_time and end_time
+    '''
+
+    cur = conn.cursor()
+
+    # earliest time that can change the numbering:
+    # new hands, their tables, and any tables that have no sess_num yet
+    query = '''SELECT MIN(time) FROM
+        (SELECT time FROM Hands
+        WHERE (table_id, hand_num) IN NewHands
+        UNION ALL
+        SELECT time FROM TableNames
+        WHERE sess_num IS NULL
+        OR table_id IN (SELECT table_id FROM NewHands))'''
+    cur.execute(query)
+    (first_time,) = cur.fetchone()
+
+    # anchor on the last numbered table before that time
+    # (no anchor renumbers all of history, starting with session 1)
+    query = '''SELECT time, sess_num
+        FROM TableNames
+        WHERE sess_num IS NOT NULL AND time < ?
+        ORDER BY time DESC
+        LIMIT 1'''
+    cur.execute(query, (first_time,))
+    row = cur.fetchone()
+    if first_time is None or row is None:
+        (anchor_time, anchor_sess) = ('', 1)
+    else:
+        (anchor_time, anchor_sess) = row
+
+    # flag a new session after each gap of >= TIME_DIFF days (LAG)
+    # and number the sessions with a running SUM of the flags
+    # (ties in time share the same running SUM, so they stay in one session)
+    query = '''WITH Gaps AS
+            (SELECT time,
+             julianday(time) - julianday(LAG(time) OVER (ORDER BY time)) AS time_diff
+            FROM Hands
+            WHERE time >= COALESCE((SELECT MAX(time) FROM Hands WHERE time <= :anchor_time), '')),
+        HandSessions AS
+            (SELECT time,
+             :anchor_sess + SUM(CASE WHEN time > :anchor_time AND time_diff >= :time_diff
+                                THEN 1 ELSE 0 END) OVER (ORDER BY time) AS sess_num
+            FROM Gaps),
+        Sessions AS
+            (SELECT sess_num,
+             CASE WHEN sess_num = :anchor_sess THEN '' ELSE MIN(time) END AS begin_time,
+             LEAD(MIN(time), 1, '9999-12-31') OVER (ORDER BY sess_num) AS end_time
+            FROM HandSessions
+            GROUP BY sess_num)
+        UPDATE TableNames
+        SET sess_num = Sessions.sess_num
+        FROM Sessions
+        WHERE TableNames.time >= :anchor_time
+        AND TableNames.time >= Sessions.begin_time AND TableNames.time < Sessions.end_time'''
+    values = {'anchor_time': anchor_time, 'anchor_sess': anchor_sess, 'time_diff': TIME_DIFF}
+    execute_query(cur, query, values, label='sess_num')
+
+    cur.close()
+
+
+def create_stats_table_sparse(conn, db_name, clear_db, db_delete=None):
     '''Creates StatPlayerHands table
-    Wish list: compute stats for new columns only XXX'''
+    Optional (db_delete) is the answer to the clear_db prompt, if it was
+    already asked (e.g., before starting parallel jobs).
+    Returns the list of StatPlayerHands columns that were added to an
+    existing table (see add_missing_columns).'''
 
     cur = conn.cursor()
 
     # delete existing databases
-    # all tourney stat DBs need to be deleted because sess_num is dynamic
-    cur.execute('DROP TABLE IF EXISTS StatTourneyPlaces')
-    cur.execute('DROP TABLE IF EXISTS StatTourneyHands')
-
+    # tourney stat DBs are updated by session in run_tourney_stats() (sess_num is dynamic)
     if TEST_RUN or clear_db:
-        db_delete = 'y'
-        if clear_db:
+        if not clear_db:
+            db_delete = 'y'
+        elif db_delete is None:
             db_delete = input(f'Clear existing stats tables for {db_name}? (Y/n): ')
         if db_delete.lower() == 'y' or db_delete == '':
             cur.execute('DROP TABLE IF EXISTS StatPlayerHands')
             cur.execute('DROP TABLE IF EXISTS StatPvP')
+            cur.execute('DROP TABLE IF EXISTS StatTourneyPlaces')
+            cur.execute('DROP TABLE IF EXISTS StatTourneyHands')
+            cur.execute('DROP TABLE IF EXISTS StatPlayerTotals')
+            cur.execute('DROP TABLE IF EXISTS StatPlayerSessions')
+            cur.execute('DROP TABLE IF EXISTS StatPvPTotals')
+            cur.execute('DROP TRIGGER IF EXISTS StatQueuePlayerHands')
+            cur.execute('DROP TABLE IF EXISTS StatQueue')
             # reduce file size
             conn.commit()
             conn.execute('VACUUM')
@@ -459,17 +985,20 @@ def create_stats_table_sparse(conn, db_name, clear_db):
          n_raises INTEGER DEFAULT 0,
          n_check_rs INTEGER DEFAULT 0,
 
+         act_pf TEXT,
+         act_flop TEXT,
+         act_turn TEXT,
+         act_river TEXT,
+
          FOREIGN KEY(table_id) REFERENCES TableNames(table_id) ON UPDATE CASCADE,
          FOREIGN KEY(player_id) REFERENCES PlayerNames(player_id) ON UPDATE CASCADE,
          UNIQUE(table_id, hand_num, player_id)
         )'''
     cur.execute(query)
+    new_cols = add_missing_columns(conn, 'StatPlayerHands', query)
 
-    query = '''INSERT OR IGNORE INTO StatPlayerHands
-        (table_id, hand_num, player_id)
-        SELECT table_id, hand_num, player_id
-        FROM PlayerHands'''
-    cur.execute(query)
+    set_stat_queue(conn)
+    insert_new_rows(conn)
 
     # create StatPvP table
     query = '''CREATE TABLE IF NOT EXISTS StatPvP
@@ -515,20 +1044,377 @@ def create_stats_table_sparse(conn, db_name, clear_db):
     conn.commit()
     cur.close()
 
+    return new_cols
+
+
+def insert_new_rows(conn):
+    '''Adds a StatPlayerHands row for each PlayerHands row that does not have one.'''
+
+    cur = conn.cursor()
+
+    # with the change queue, only the queued rows can be missing
+    # (rows are added in key order either way, which orders players within a hand in row_num)
+    if STAT_QUEUE:
+        source_name = 'StatQueue'
+    else:
+        source_name = 'PlayerHands'
+    query = f'''INSERT OR IGNORE INTO StatPlayerHands
+        (table_id, hand_num, player_id)
+        SELECT table_id, hand_num, player_id
+        FROM {source_name}
+        ORDER BY table_id, hand_num, player_id'''
+    cur.execute(query)
+
+    cur.close()
+
+
+def set_stat_queue(conn):
+    '''Installs or removes the change queue, as set by STAT_QUEUE.
+    The change queue is a table (StatQueue) of the PlayerHands rows that do not
+    have stats yet, filled by a trigger as rows are inserted into PlayerHands
+    (e.g., by history.py), so that the stats run only reads the queue instead of
+    every hand (see create_new_actions_table). Rows without stats are queued once
+    when the queue is installed, and hands are cleared from the queue when their
+    stats are added (see clear_stat_queue). Returns True if the queue is installed.'''
+
+    cur = conn.cursor()
+
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'StatQueuePlayerHands'"
+    installed = cur.execute(query).fetchone() is not None
+
+    if STAT_QUEUE and not installed:
+        print('Installing change queue...')
+        query = '''CREATE TABLE IF NOT EXISTS StatQueue
+            (table_id INTEGER,
+             hand_num INTEGER,
+             player_id INTEGER,
+             UNIQUE(table_id, hand_num, player_id)
+            )'''
+        cur.execute(query)
+        query = '''INSERT OR IGNORE INTO StatQueue
+            SELECT table_id, hand_num, player_id
+            FROM PlayerHands LEFT JOIN StatPlayerHands USING (table_id, hand_num, player_id)
+            WHERE StatPlayerHands.date_added IS NULL'''
+        cur.execute(query)
+        print(f'...Queued {cur.rowcount} rows without stats')
+        query = '''CREATE TRIGGER StatQueuePlayerHands AFTER INSERT ON PlayerHands
+            BEGIN
+             INSERT OR IGNORE INTO StatQueue VALUES (NEW.table_id, NEW.hand_num, NEW.player_id);
+            END'''
+        cur.execute(query)
+    elif not STAT_QUEUE and installed:
+        print('Removing change queue...')
+        cur.execute('DROP TRIGGER StatQueuePlayerHands')
+        cur.execute('DROP TABLE IF EXISTS StatQueue')
+
+    conn.commit()
+    cur.close()
+
+    return STAT_QUEUE
+
+
+def clear_stat_queue(conn):
+    '''Clears the new hands (NewHands) from the change queue, if installed
+    (see set_stat_queue). Called in the same transaction that sets date_added.'''
+
+    if not STAT_QUEUE:
+        return
+
+    cur = conn.cursor()
+    query = 'DELETE FROM StatQueue WHERE (table_id, hand_num) IN NewHands'
+    execute_query(cur, query, label='clear_stat_queue')
+    cur.close()
+
+
+def add_missing_columns(conn, table_name, create_query):
+    '''Compares the columns of an existing table (table_name) with its
+    definition in code (create_query, a CREATE TABLE IF NOT EXISTS query)
+    and adds the missing columns with ALTER TABLE.
+    Returns the list of added columns.'''
+
+    cur = conn.cursor()
+
+    # let SQLite parse the definition by creating an empty temporary copy
+    cur.execute('DROP TABLE IF EXISTS temp.DefinedColumns')
+    query = create_query.replace(f'CREATE TABLE IF NOT EXISTS {table_name}',
+                                 'CREATE TEMPORARY TABLE DefinedColumns', 1)
+    cur.execute(query)
+
+    # PRAGMA table_info: (cid, name, type, notnull, dflt_value, pk)
+    cur.execute(f'PRAGMA main.table_info({table_name})')
+    existing_cols = {row[1] for row in cur.fetchall()}
+    cur.execute('PRAGMA temp.table_info(DefinedColumns)')
+    defined_list = cur.fetchall()
+
+    new_cols = []
+    for (_, col, col_type, _, default, _) in defined_list:
+        if col in existing_cols:
+            continue
+        print(f'...Adding column {table_name}.{col}')
+        query = f'ALTER TABLE {table_name} ADD COLUMN {col} {col_type}'
+        if default is not None:
+            query += f' DEFAULT {default}'
+        cur.execute(query)
+        new_cols.append(col)
+
+    cur.execute('DROP TABLE temp.DefinedColumns')
+    conn.commit()
+    cur.close()
+
+    return new_cols
+
+
+def calc_new_columns(conn, new_cols):
+    '''Calculates newly-added StatPlayerHands columns (new_cols) for the
+    hands that already have stats, without resetting the other columns or
+    date_added. New hands are calculated by the regular stats run.'''
+
+    registry = [stat for stat in build_stat_registry() if stat['name'] in new_cols]
+    registry_names = [stat['name'] for stat in registry]
+
+    # row_num and bal_bb_running are set for every hand by set_running_totals()
+    # on this run; e.g., date_added is only set for new hands
+    for col in new_cols:
+        if col in ['row_num', 'bal_bb_running']:
+            print(f'...New column {col} is set for the existing hands after the new hands')
+        elif col not in registry_names:
+            print(f'...New column {col} is set on the next run with new hands')
+
+    if not registry:
+        return
+
+    print()
+    print('Calculating new columns for existing hands...')
+    num_actions = create_new_actions_table(conn, existing=True)
+    if num_actions > 0:
+        create_new_hands_table(conn)
+        run_stat_registry(conn, registry)
+        print()
+
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS temp.NewActions')
+    cur.execute('DROP TABLE IF EXISTS temp.NewHands')
+    conn.commit()
+    cur.close()
+
+
+def rollup_columns(conn):
+    '''Returns a list of (column, type) tuples for the StatPlayerHands columns
+    that are summed in the rollup tables (see create_rollup_tables).'''
+
+    # keys, row numbers, and timestamps don't add up
+    skip_list = ['row_num', 'table_id', 'hand_num', 'player_id', 'date_added', 'bal_bb_running']
+
+    cur = conn.cursor()
+    # PRAGMA table_info: (cid, name, type, notnull, dflt_value, pk)
+    cur.execute('PRAGMA main.table_info(StatPlayerHands)')
+    col_list = []
+    for row in cur.fetchall():
+        (col, col_type) = (row[1], row[2])
+        # neither do action codes
+        if col in skip_list or col_type == 'TEXT':
+            continue
+        # sums of booleans are counts
+        if col_type == 'BOOLEAN':
+            col_type = 'INTEGER'
+        col_list.append((col, col_type))
+    cur.close()
+
+    return col_list
+
+
+def create_rollup_tables(conn):
+    '''Creates the rollup tables, which hold the sums of each StatPlayerHands
+    column (numerators and denominators, e.g. vpip and n_hands) so that
+    dashboards don't have to add up every hand:
+     StatPlayerTotals: by player_id
+     StatPlayerSessions: by player_id and sess_num
+     StatPvPTotals: StatPvP by player_id and opp_id
+    Adds new StatPlayerHands columns to the rollup tables. If any columns
+    were added (or the tables are new), rebuilds the rollup tables from the
+    hands that already have stats. Call after calc_new_columns().'''
+
+    cur = conn.cursor()
+
+    col_list = rollup_columns(conn)
+    col_str = ''.join(f'{col} {col_type} DEFAULT 0,\n         ' for (col, col_type) in col_list)
+
+    rebuild = False
+    query = f'''CREATE TABLE IF NOT EXISTS StatPlayerTotals
+        (player_id INTEGER,
+         n_hands INTEGER DEFAULT 0,
+         {col_str}
+         FOREIGN KEY(player_id) REFERENCES PlayerNames(player_id) ON UPDATE CASCADE,
+         UNIQUE(player_id)
+        )'''
+    cur.execute(query)
+    rebuild = add_missing_columns(conn, 'StatPlayerTotals', query) or rebuild
+
+    query = f'''CREATE TABLE IF NOT EXISTS StatPlayerSessions
+        (player_id INTEGER,
+         sess_num INTEGER,
+         n_hands INTEGER DEFAULT 0,
+         {col_str}
+         FOREIGN KEY(player_id) REFERENCES PlayerNames(player_id) ON UPDATE CASCADE,
+         UNIQUE(player_id, sess_num)
+        )'''
+    cur.execute(query)
+    rebuild = add_missing_columns(conn, 'StatPlayerSessions', query) or rebuild
+
+    query = '''CREATE TABLE IF NOT EXISTS StatPvPTotals
+        (player_id INTEGER,
+         opp_id INTEGER,
+         n_hands INTEGER DEFAULT 0,
+         net_chips INTEGER DEFAULT 0,
+         net_bb FLOAT DEFAULT 0,
+         FOREIGN KEY(player_id) REFERENCES PlayerNames(player_id) ON UPDATE CASCADE,
+         FOREIGN KEY(opp_id) REFERENCES PlayerNames(player_id) ON UPDATE CASCADE,
+         UNIQUE(player_id, opp_id)
+        )'''
+    cur.execute(query)
+
+    # new (empty) rollup tables also need to be rebuilt if there are existing hands
+    cur.execute('SELECT COUNT(*) FROM StatPlayerTotals')
+    if cur.fetchone()[0] == 0:
+        rebuild = True
+
+    if rebuild:
+        print('Rebuilding rollup tables...')
+        cur.execute('DELETE FROM StatPlayerTotals')
+        cur.execute('DELETE FROM StatPlayerSessions')
+        cur.execute('DELETE FROM StatPvPTotals')
+        update_rollups(conn, new_only=False)
+
+    conn.commit()
+    cur.close()
+
 
-def create_new_actions_table(conn):
-    '''Creates temporary table of new actions'''
+def update_rollups(conn, new_only=True):
+    '''Adds the stats of the new hands (NewHands) to the rollup tables
+    (see create_rollup_tables). Player and PvP totals are added to; sessions
+    from the earliest session with new hands on are recalculated, because
+    set_sessions() can renumber them.
+    Use (new_only)=False to add all hands that already have stats instead.'''
+
+    '''
+    The general form of the query is
+     INSERT INTO StatPlayerTotals (player_id, n_hands, col1, ...)
+     SELECT player_id, COUNT(*), COALESCE(SUM(col1), 0), ...
+     FROM StatPlayerHands
+     WHERE (table_id, hand_num) IN NewHands
+     GROUP BY player_id
+     ON CONFLICT (player_id) DO UPDATE
+     SET n_hands = n_hands + excluded.n_hands, col1 = col1 + excluded.col1, ...
+    '''
+
+    cur = conn.cursor()
+
+    col_list = [col for (col, _) in rollup_columns(conn)]
+    insert_str = ', '.join(['n_hands'] + col_list)
+    sum_str = ', '.join(['COUNT(*)'] + [f'COALESCE(SUM({col}), 0)' for col in col_list])
+    add_str = ', '.join(f'{col} = {col} + excluded.{col}' for col in ['n_hands'] + col_list)
+
+    if new_only:
+        hand_str = '(table_id, hand_num) IN NewHands'
+    else:
+        hand_str = 'date_added IS NOT NULL'
+
+    # ON CONFLICT needs a WHERE clause in the SELECT
+    query = (f'INSERT INTO StatPlayerTotals (player_id, {insert_str})'
+             + f' SELECT player_id, {sum_str}'
+             + ' FROM StatPlayerHands'
+             + f' WHERE {hand_str}'
+             + ' GROUP BY player_id'
+             + f' ON CONFLICT (player_id) DO UPDATE SET {add_str}')
+    execute_query(cur, query, label='StatPlayerTotals')
+
+    # recalculate sessions that can change
+    if new_only:
+        query = '''SELECT MIN(sess_num) FROM TableNames
+            WHERE table_id IN (SELECT table_id FROM NewHands)'''
+        cur.execute(query)
+        (first_sess,) = cur.fetchone()
+    else:
+        first_sess = None
+    if first_sess is None:
+        first_sess = 0
+    cur.execute('DELETE FROM StatPlayerSessions WHERE sess_num >= ?', (first_sess,))
+    query = (f'INSERT INTO StatPlayerSessions (player_id, sess_num, {insert_str})'
+             + f' SELECT player_id, sess_num, {sum_str}'
+             + ' FROM StatPlayerHands JOIN TableNames USING (table_id)'
+             + ' WHERE sess_num >= ? AND date_added IS NOT NULL'
+             + ' GROUP BY player_id, sess_num')
+    execute_query(cur, query, (first_sess,), label='StatPlayerSessions')
+
+    if new_only:
+        hand_str = '(table_id, hand_num) IN NewHands'
+    else:
+        hand_str = '''(table_id, hand_num) IN
+            (SELECT table_id, hand_num FROM StatPlayerHands WHERE date_added IS NOT NULL)'''
+    query = f'''INSERT INTO StatPvPTotals (player_id, opp_id, n_hands, net_chips, net_bb)
+        SELECT player_id, opp_id, COUNT(*), COALESCE(SUM(net_chips), 0), COALESCE(SUM(net_bb), 0)
+        FROM StatPvP
+        WHERE {hand_str}
+        GROUP BY player_id, opp_id
+        ON CONFLICT (player_id, opp_id) DO UPDATE
+        SET n_hands = n_hands + excluded.n_hands,
+            net_chips = net_chips + excluded.net_chips,
+            net_bb = net_bb + excluded.net_bb'''
+    execute_query(cur, query, label='StatPvPTotals')
+
+    commit_stats(conn)
+    cur.close()
+
+
+def stat_source(existing=False):
+    '''Returns the FROM clause that joins the actions to StatPlayerHands for
+    finding new actions. With the change queue (see set_stat_queue), only the
+    queued rows are joined, unless (existing) selects the actions that already
+    have stats.'''
+
+    if STAT_QUEUE and not existing:
+        # CROSS JOIN keeps the queue as the outer loop
+        return ('StatQueue CROSS JOIN StatPlayerHands USING (table_id, hand_num, player_id)'
+                + ' CROSS JOIN Actions USING (table_id, hand_num, player_id)')
+    else:
+        return 'Actions JOIN StatPlayerHands USING (table_id, hand_num, player_id)'
+
+
+def create_new_actions_table(conn, chunk_range=None, existing=False, table_range=None):
+    '''Creates temporary table of new actions
+    Optional (chunk_range) is a (first, last) tuple of PendingHands rows
+    to limit the new actions to one chunk of hands.
+    Optional (table_range) is a (first, last) tuple of table_ids
+    to limit the new actions to one shard of tables (see run_stats_shard).
+    Optional boolean (existing) selects the actions that already have stats
+    instead (e.g., to calculate new columns; see calc_new_columns).'''
 
     cur = conn.cursor()
 
     # select actions from hands that have not yet been added
     # currently checks for null; check for older date XXX
-    print('Adding new actions to database...')
-    query = '''CREATE TEMPORARY TABLE IF NOT EXISTS NewActions AS
+    if existing:
+        null_str = 'IS NOT NULL'
+        print('Selecting existing actions...')
+    else:
+        null_str = 'IS NULL'
+        print('Adding new actions to database...')
+    query = f'''CREATE TEMPORARY TABLE IF NOT EXISTS NewActions AS
         SELECT Actions.*
-        FROM Actions JOIN StatPlayerHands USING (table_id, hand_num, player_id)
-        WHERE StatPlayerHands.date_added IS NULL'''
-    cur.execute(query)
+        FROM {stat_source(existing)}
+        WHERE StatPlayerHands.date_added {null_str}'''
+    if table_range is not None:
+        query += '''
+        AND table_id BETWEEN ? AND ?'''
+        cur.execute(query, table_range)
+    elif chunk_range is None:
+        cur.execute(query)
+    else:
+        query += '''
+        AND (table_id, hand_num) IN
+            (SELECT table_id, hand_num FROM PendingHands
+            WHERE rowid BETWEEN ? AND ?)'''
+        cur.execute(query, chunk_range)
 
     # calculate number of newly-added actions
     query = 'SELECT COUNT(*) FROM NewActions'
@@ -539,11 +1425,84 @@ def create_new_actions_table(conn):
     conn.commit()
     cur.close()
 
-    return num_new
+    return num_new
+
+
+def create_chunked_actions_table(conn, chunk_hands, is_tourney=False):
+    '''Chunked version of create_new_actions_table() for very large sets of
+    new actions (e.g., the first run on a multi-year history).
+    Calculates stats for the new hands in chunks of (chunk_hands) hands,
+    oldest first, so temporary tables are limited by the chunk size.
+    Each chunk is committed with its date_added stamp, so an interrupted run
+    resumes from the last finished chunk.
+    The last chunk is left in NewActions for the rest of the stats run
+    (e.g., run_final_stats). Optional boolean (is_tourney) also runs the
+    tournament stats for each chunk's sessions (see create_touched_sessions_table).
+    Returns a tuple of (total number of new actions, total number of new hands).'''
+
+    cur = conn.cursor()
+
+    # list hands that have not yet been added, in order
+    # (rowid follows insertion order, so it numbers the hands by time)
+    print('Finding new hands...')
+    cur.execute('DROP TABLE IF EXISTS temp.PendingHands')
+    query = f'''CREATE TEMPORARY TABLE PendingHands AS
+        SELECT table_id, hand_num
+        FROM Hands
+        WHERE (table_id, hand_num) IN
+            (SELECT table_id, hand_num
+            FROM {stat_source()}
+            WHERE StatPlayerHands.date_added IS NULL)
+        ORDER BY time, table_id, hand_num'''
+    cur.execute(query)
+    num_hands = cur.execute('SELECT COUNT(*) FROM PendingHands').fetchone()[0]
+    print(f'Number of new hands found: {num_hands}')
+    conn.commit()
+
+    registry = build_stat_registry()
+    num_new = 0
+    chunk_first = 1
+    while True:
+        chunk_last = chunk_first + chunk_hands - 1
+
+        print()
+        print(f'Chunk of hands {chunk_first}-{min(chunk_last, num_hands)} of {num_hands}')
+        cur.execute('DROP TABLE IF EXISTS temp.NewActions')
+        cur.execute('DROP TABLE IF EXISTS temp.NewHands')
+        num_new += create_new_actions_table(conn, (chunk_first, chunk_last))
+
+        # last chunk is finished by the rest of the stats run
+        if chunk_last >= num_hands:
+            break
+
+        create_new_hands_table(conn)
+        run_hand_stats(conn, registry)
+        with stat_group(conn, 'pvp_stats'):
+            run_pvp_stats(conn)
+        with stat_group(conn, 'date_added'):
+            calc_action(conn, 'date_added', 'True', val="strftime('%Y-%m-%d %H:%M:%f', 'now')")
+            clear_stat_queue(conn)
+        # rollup sessions need sess_num for the new tables
+        with stat_group(conn, 'rollup_stats'):
+            set_sessions(conn)
+            update_rollups(conn)
+        if is_tourney:
+            with stat_group(conn, 'tourney_stats'):
+                run_tourney_stats(conn)
+        conn.commit()
+
+        chunk_first = chunk_last + 1
+
+    print()
+    cur.execute('DROP TABLE IF EXISTS temp.PendingHands')
+    conn.commit()
+    cur.close()
+
+    return (num_new, num_hands)
 
 
 def create_new_hands_table(conn):
-    '''Creates temporary table of new hands'''
+    '''Creates temporary table of new hands. Returns the number of new hands.'''
 
     cur = conn.cursor()
 
@@ -565,64 +1524,66 @@ def create_new_hands_table(conn):
     conn.commit()
     cur.close()
 
+    return num_new
+
 
-def run_preflop_stats(conn):
-    '''Helper method for calling each of the preflop stats methods.'''
+def register_preflop_stats(registry):
+    '''Adds each of the preflop stats to the stat registry.'''
     
     # VPIP (any preflop call, bet, or raise)
     # p. 29
     stat_cond = f'street = {PREFLOP_VAL} AND action_id >= {CALL_VAL}'
-    calc_action(conn, 'vpip', stat_cond)
+    add_stat(registry, 'vpip', 'action', stat_cond)
     
     # PFR (any preflop raise)
     stat_cond = f'street = {PREFLOP_VAL} AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'pfr', stat_cond)
+    add_stat(registry, 'pfr', 'action', stat_cond)
     
     # All potential 3-bets (preflop pot has been raised exactly once)
     base_cond = f'street = {PREFLOP_VAL} AND bet_level = 2'
-    calc_action(conn, 'n_threebet', base_cond)
+    add_stat(registry, 'n_threebet', 'action', base_cond)
     
     # 3-bet (preflop raise when pot has already been raised exactly once)
     # p. 52
     stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'threebet', stat_cond)
+    add_stat(registry, 'threebet', 'action', stat_cond)
     
     # All potential 4-bets (preflop pot has been raised exactly twice)
     base_cond = f'street = {PREFLOP_VAL} AND bet_level = 3'
-    calc_action(conn, 'n_fourbet', base_cond)
+    add_stat(registry, 'n_fourbet', 'action', base_cond)
     
     # 4-bet (preflop raise when pot has already been raised exactly twice)
     # Low/med/high assumed to be 3-bet * 2/3 (2%/5%/8%)
     stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'fourbet', stat_cond)
+    add_stat(registry, 'fourbet', 'action', stat_cond)
         
     # All facing a 3-bet after open (preflop raise, then facing one re-raise)
-    base_cond = (f'street = {PREFLOP_VAL} AND a1.bet_level <= 1'
-                 + f' AND a1.action_id = {RAISE_VAL} AND a2.bet_level = 3')
-    calc_seq_action(conn, 'n_face3bet', base_cond)
+    first_cond = f'bet_level <= 1 AND action_id = {RAISE_VAL}'
+    base_cond = f'street = {PREFLOP_VAL} AND bet_level = 3'
+    add_stat(registry, 'n_face3bet', 'seq', base_cond, first_cond=first_cond, street=PREFLOP_VAL)
     
     # Reraise 3-bet ("4-bet after open")
-    stat_cond = base_cond + f' AND a2.action_id = {RAISE_VAL}'
-    calc_seq_action(conn, 'rr3bet', stat_cond)
+    stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
+    add_stat(registry, 'rr3bet', 'seq', stat_cond, first_cond=first_cond, street=PREFLOP_VAL)
 
     # Call 3-bet after open (mostly just a sanity check for rr/fold numbers)
-    stat_cond = base_cond + f' AND a2.action_id = {CALL_VAL}'
-    calc_seq_action(conn, 'call3bet', stat_cond)
+    stat_cond = base_cond + f' AND action_id = {CALL_VAL}'
+    add_stat(registry, 'call3bet', 'seq', stat_cond, first_cond=first_cond, street=PREFLOP_VAL)
     
     # Fold to 3-bet after open
     # p. 327
-    stat_cond = base_cond + f' AND a2.action_id = {FOLD_VAL}'
-    calc_seq_action(conn, 'foldto3bet', stat_cond)
+    stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
+    add_stat(registry, 'foldto3bet', 'seq', stat_cond, first_cond=first_cond, street=PREFLOP_VAL)
         
     # All facing a 4-bet after 3-bet (preflop 3-bet, then facing one re-raise)
-    base_cond = (f'street = {PREFLOP_VAL} AND a1.bet_level = 2'
-                 + f' AND a1.action_id = {RAISE_VAL} AND a2.bet_level = 4')
-    calc_seq_action(conn, 'n_face4bet', base_cond)
+    first_cond = f'bet_level = 2 AND action_id = {RAISE_VAL}'
+    base_cond = f'street = {PREFLOP_VAL} AND bet_level = 4'
+    add_stat(registry, 'n_face4bet', 'seq', base_cond, first_cond=first_cond, street=PREFLOP_VAL)
     
     # Fold to 4-bet after 3-bet
     # p. 378
-    stat_cond = base_cond + f' AND a2.action_id = {FOLD_VAL}'
-    calc_seq_action(conn, 'foldto4bet', stat_cond)
+    stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
+    add_stat(registry, 'foldto4bet', 'seq', stat_cond, first_cond=first_cond, street=PREFLOP_VAL)
     
     # Fold vs button open XXX
     # p. 47
@@ -633,69 +1594,71 @@ def run_preflop_stats(conn):
     # All possible call pf open (fisrt caller, excludes BB)
     base_cond = (f'street = {PREFLOP_VAL} AND bet_level = 2 AND n_commit <= 1'
                  + f' AND (pos < {BB_VAL} OR pos >= {SB_VAL})')
-    calc_action(conn, 'n_callopen', base_cond, join_p_hands=True)
+    add_stat(registry, 'n_callopen', 'action', base_cond, join='p_hands')
     
     # Call pf open (first caller, excludes BB)
     stat_cond = base_cond + f' AND action_id = {CALL_VAL}'
-    calc_action(conn, 'callopen', stat_cond, join_p_hands=True)
+    add_stat(registry, 'callopen', 'action', stat_cond, join='p_hands')
+
+    return registry
     
         
-def run_cbet_stats(conn):
-    '''Helper method for calling each of the cbet stats methods.'''
+def register_cbet_stats(registry):
+    '''Adds each of the cbet stats to the stat registry.'''
     
     # All potential cbets on flop (opportunity to open flop as preflop aggressor)
     base_cond = f'street = {FLOP_VAL} AND bet_level = 0 AND player_id = pf_agg_id'
-    calc_action(conn, 'n_cbet_flop', base_cond, join_hands=True)
+    add_stat(registry, 'n_cbet_flop', 'action', base_cond, join='hands')
     
     # Cbet flop (open flop as preflop aggressor)
     # p. 222
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    calc_action(conn, 'cbet_flop', stat_cond, join_hands=True)
+    add_stat(registry, 'cbet_flop', 'action', stat_cond, join='hands')
 
     # All potential cbets on turn (opportunity to open turn as flop aggressor)
     base_cond = f'street = {TURN_VAL} AND bet_level = 0 AND player_id = flop_agg_id'
     # base_cond = (f'street = {TURN_VAL} AND bet_level = 0 AND player_id = pf_agg_id'
     #             + ' AND player_id = flop_agg_id')
-    calc_action(conn, 'n_cbet_turn', base_cond, join_hands=True)
+    add_stat(registry, 'n_cbet_turn', 'action', base_cond, join='hands')
 
     # Cbet turn (open turn as flop aggressor)
     # p. 223
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    calc_action(conn, 'cbet_turn', stat_cond, join_hands=True)
+    add_stat(registry, 'cbet_turn', 'action', stat_cond, join='hands')
 
     # All potential cbets on river (opportunity to open river as turn aggressor)
     base_cond = f'street = {RIVER_VAL} AND bet_level = 0 AND player_id = turn_agg_id'
     # base_cond = (f'street = {RIVER_VAL} AND bet_level = 0 AND player_id = pf_agg_id'
     #             + ' AND player_id = flop_agg_id AND player_id = turn_agg_id')
-    calc_action(conn, 'n_cbet_river', base_cond, join_hands=True)
+    add_stat(registry, 'n_cbet_river', 'action', base_cond, join='hands')
 
     # Cbet river (open river as turn aggressor)
     # p. 224
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    calc_action(conn, 'cbet_river', stat_cond, join_hands=True)
+    add_stat(registry, 'cbet_river', 'action', stat_cond, join='hands')
     
     # All cbets faced on flop (facing opening flop bet by preflop aggressor)
     base_cond = f'street = {FLOP_VAL} AND bet_level = 1 AND agg_id = pf_agg_id'
-    calc_action(conn, 'n_faced_cbet_flop', base_cond, join_hands=True)
+    add_stat(registry, 'n_faced_cbet_flop', 'action', base_cond, join='hands')
     
     # Fold to flop cbet (fold to opening flop bet by preflop aggressor)
     # p. 56
     stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
-    calc_action(conn, 'foldto_cbet_flop', stat_cond, join_hands=True)
+    add_stat(registry, 'foldto_cbet_flop', 'action', stat_cond, join='hands')
 
     # Raise flop cbet (raise opening flop bet by preflop aggressor)
     # p. 104
     stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'raise_cbet_flop', stat_cond, join_hands=True)
+    add_stat(registry, 'raise_cbet_flop', 'action', stat_cond, join='hands')
     
     # All cbets faced on flop from preflop 3-bettor
     base_cond = base_cond + ' AND pf_bet_level = 3'
-    calc_action(conn, 'n_faced_3cbet_flop', base_cond, join_hands=True)
+    add_stat(registry, 'n_faced_3cbet_flop', 'action', base_cond, join='hands')
     
     # Fold to flop cbet from preflop 3-bettor
     # Low/med/high assumed to be fold to flop cbet + 5% (42.5%/55%/67.5%)
     stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
-    calc_action(conn, 'foldto_3cbet_flop', stat_cond, join_hands=True)
+    add_stat(registry, 'foldto_3cbet_flop', 'action', stat_cond, join='hands')
 
     '''What defines a cbet on the turn or river? In increasing strictness:
         1. Opening bet as the aggressor of the previous street
@@ -714,7 +1677,7 @@ def run_cbet_stats(conn):
 
     # All cbets faced on turn (facing opening turn bet by hand aggressor)
     base_cond = f'street = {TURN_VAL} AND bet_level = 1 AND agg_id = flop_agg_id'
-    calc_action(conn, 'n_faced_cbet_turn', base_cond, join_hands=True)
+    add_stat(registry, 'n_faced_cbet_turn', 'action', base_cond, join='hands')
     # base_cond = (f'street = {TURN_VAL} AND bet_level = 1 AND agg_id = pf_agg_id'
     #              + ' AND agg_id = flop_agg_id')
     # base_cond2 = 'n_faced_cbet_flop = 1'
@@ -722,12 +1685,12 @@ def run_cbet_stats(conn):
     
     # Fold to turn cbet (fold to opening turn bet by hand aggressor)
     stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
-    calc_action(conn, 'foldto_cbet_turn', stat_cond, join_hands=True)
+    add_stat(registry, 'foldto_cbet_turn', 'action', stat_cond, join='hands')
     # calc_action(conn, 'foldto_cbet_turn', stat_cond, base_cond2, join_hands=True)
 
     # All cbets faced on river (facing opening river bet by hand aggressor)
     base_cond = f'street = {RIVER_VAL} AND bet_level = 1 AND agg_id = turn_agg_id'
-    calc_action(conn, 'n_faced_cbet_river', base_cond, join_hands=True)
+    add_stat(registry, 'n_faced_cbet_river', 'action', base_cond, join='hands')
     # base_cond = (f'street = {RIVER_VAL} AND bet_level = 1 AND agg_id = pf_agg_id'
     #             + ' AND agg_id = flop_agg_id AND agg_id = turn_agg_id')
     # base_cond2 = 'n_faced_cbet_flop = 1 AND n_faced_cbet_turn = 1'
@@ -735,129 +1698,147 @@ def run_cbet_stats(conn):
                 
     # Fold to river cbet (fold to opening river bet by hand aggressor)
     stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
-    calc_action(conn, 'foldto_cbet_river', stat_cond, join_hands=True)
+    add_stat(registry, 'foldto_cbet_river', 'action', stat_cond, join='hands')
     # calc_action(conn, 'foldto_cbet_river', stat_cond, base_cond2, join_hands=True)
 
+    return registry
+
 
-def run_stab_stats(conn):
-    '''Helper method for calling each of the stab/donk stats methods.'''
+def register_stab_stats(registry):
+    '''Adds each of the stab/donk stats to the stat registry.'''
     
     # All potential flop stabs (opp to open flop after preflop aggressor checked)
-    base_cond = (f'street = {FLOP_VAL} AND a1.player_id = pf_agg_id'
-                 + f' AND a1.action_id = {CHECK_VAL} AND a2.bet_level = 0')
-    calc_seq_action(conn, 'n_stab_flop', base_cond, same_player=False, join_hands=True)
+    first_cond = f'player_id = pf_agg_id AND action_id = {CHECK_VAL}'
+    base_cond = f'street = {FLOP_VAL} AND bet_level = 0'
+    add_stat(registry, 'n_stab_flop', 'seq', base_cond, first_cond=first_cond,
+             same_player=False, join='hands', street=FLOP_VAL)
     
     # Stab flop (open flop after preflop aggressor checked)
     # p. 146
-    stat_cond = base_cond + f' AND a2.action_id = {BET_VAL}'
-    calc_seq_action(conn, 'stab_flop', stat_cond, same_player=False, join_hands=True)
+    stat_cond = base_cond + f' AND action_id = {BET_VAL}'
+    add_stat(registry, 'stab_flop', 'seq', stat_cond, first_cond=first_cond,
+             same_player=False, join='hands', street=FLOP_VAL)
 
     # All potential turn stabs (opp to open turn after flop aggressor checked)
-    base_cond = (f'street = {TURN_VAL} AND a1.player_id = flop_agg_id'
-                 + f' AND a1.action_id = {CHECK_VAL} AND a2.bet_level = 0')
-    calc_seq_action(conn, 'n_stab_turn', base_cond, same_player=False, join_hands=True)
+    first_cond = f'player_id = flop_agg_id AND action_id = {CHECK_VAL}'
+    base_cond = f'street = {TURN_VAL} AND bet_level = 0'
+    add_stat(registry, 'n_stab_turn', 'seq', base_cond, first_cond=first_cond,
+             same_player=False, join='hands', street=TURN_VAL)
     
     # Stab turn (open turn after flop aggressor checked)
-    stat_cond = base_cond + f' AND a2.action_id = {BET_VAL}'
-    calc_seq_action(conn, 'stab_turn', stat_cond, same_player=False, join_hands=True)
+    stat_cond = base_cond + f' AND action_id = {BET_VAL}'
+    add_stat(registry, 'stab_turn', 'seq', stat_cond, first_cond=first_cond,
+             same_player=False, join='hands', street=TURN_VAL)
 
     # All potential river stabs (opp to open river after turn aggressor checked)
-    base_cond = (f'street = {RIVER_VAL} AND a1.player_id = turn_agg_id'
-                 + f' AND a1.action_id = {CHECK_VAL} AND a2.bet_level = 0')
-    calc_seq_action(conn, 'n_stab_river', base_cond, same_player=False, join_hands=True)
+    first_cond = f'player_id = turn_agg_id AND action_id = {CHECK_VAL}'
+    base_cond = f'street = {RIVER_VAL} AND bet_level = 0'
+    add_stat(registry, 'n_stab_river', 'seq', base_cond, first_cond=first_cond,
+             same_player=False, join='hands', street=RIVER_VAL)
     
     # Stab river (open river after turn aggressor checked)
-    stat_cond = base_cond + f' AND a2.action_id = {BET_VAL}'
-    calc_seq_action(conn, 'stab_river', stat_cond, same_player=False, join_hands=True)
+    stat_cond = base_cond + f' AND action_id = {BET_VAL}'
+    add_stat(registry, 'stab_river', 'seq', stat_cond, first_cond=first_cond,
+             same_player=False, join='hands', street=RIVER_VAL)
     
     # All potential flop donks (betting into pf agressor before aggressor can act)
     base_cond = (f'street = {FLOP_VAL} AND player_id != pf_agg_id'
                  + ' AND pf_agg_id IS NOT NULL AND bet_level = 0')
     base_cond2 = 'n_stab_flop IS NULL'
-    calc_action(conn, 'n_donk_flop', base_cond, base_cond2, join_hands=True)
+    add_stat(registry, 'n_donk_flop', 'action', base_cond, base_cond2, join='hands',
+             deps=['n_stab_flop'])
     
     # Donk flop (bet into preflop aggressor before aggressor can act)
     # p. 295
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    calc_action(conn, 'donk_flop', stat_cond, base_cond2, join_hands=True)
+    add_stat(registry, 'donk_flop', 'action', stat_cond, base_cond2, join='hands',
+             deps=['n_stab_flop'])
 
     # All potential turn donks (betting into flop agressor before aggressor can act)
     base_cond = (f'street = {TURN_VAL} AND player_id != flop_agg_id'
                  + ' AND flop_agg_id IS NOT NULL AND bet_level = 0')
     base_cond2 = 'n_stab_turn IS NULL'
-    calc_action(conn, 'n_donk_turn', base_cond, base_cond2, join_hands=True)
+    add_stat(registry, 'n_donk_turn', 'action', base_cond, base_cond2, join='hands',
+             deps=['n_stab_turn'])
     
     # Donk turn (bet into flop aggressor before aggressor can act)
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    calc_action(conn, 'donk_turn', stat_cond, base_cond2, join_hands=True)
+    add_stat(registry, 'donk_turn', 'action', stat_cond, base_cond2, join='hands',
+             deps=['n_stab_turn'])
 
     # All potential river donks (betting into turn agressor before aggressor can act)
     base_cond = (f'street = {RIVER_VAL} AND player_id != turn_agg_id'
                  + ' AND turn_agg_id IS NOT NULL AND bet_level = 0')
     base_cond2 = 'n_stab_river IS NULL'
-    calc_action(conn, 'n_donk_river', base_cond, base_cond2, join_hands=True)
+    add_stat(registry, 'n_donk_river', 'action', base_cond, base_cond2, join='hands',
+             deps=['n_stab_river'])
     
     # Donk river (bet into turn aggressor before aggressor can act)
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    calc_action(conn, 'donk_river', stat_cond, base_cond2, join_hands=True)
+    add_stat(registry, 'donk_river', 'action', stat_cond, base_cond2, join='hands',
+             deps=['n_stab_river'])
+
+    return registry
 
 
-def run_rfi_stats(conn):
-    '''Helper method for calling each of the raise first in stats methods.'''
+def register_rfi_stats(registry):
+    '''Adds each of the raise first in stats to the stat registry.'''
     
     # All potential raise first in from any position (opp to open preflop)
     # Excludes blind posts by limiting to action_id >= FOLD_VAL
     base_cond = f'street = {PREFLOP_VAL} AND bet_level = 0'
     base_cond2 = base_cond + f' AND action_id >= {FOLD_VAL}'
-    calc_action(conn, 'n_rfi', base_cond2)
+    add_stat(registry, 'n_rfi', 'action', base_cond2)
     
     # Raise first in from any position (open preflop with a raise)
     stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'rfi', stat_cond)
+    add_stat(registry, 'rfi', 'action', stat_cond)
     
     for pos_index in range(POS_MIN, POS_MAX + 1):
         
         # All potential raise first in from given position (opp to open preflop)
         base_cond2 = base_cond + f' AND pos = {pos_index}'
         stat_cond = base_cond2 + f' AND action_id >= {FOLD_VAL}'
-        calc_action(conn, f'n_rfi_{pos_index}', stat_cond, join_p_hands=True)
+        add_stat(registry, f'n_rfi_{pos_index}', 'action', stat_cond, join='p_hands')
         
         # Raise first in from given position (open preflop with a raise)
         # p. 177
         stat_cond = base_cond2 + f' AND action_id = {RAISE_VAL}'
-        calc_action(conn, f'rfi_{pos_index}', stat_cond, join_p_hands=True)
+        add_stat(registry, f'rfi_{pos_index}', 'action', stat_cond, join='p_hands')
 
     # All potential raise first in from BB (opp to open preflop)
     base_cond2 = base_cond + f' AND pos BETWEEN {BB_VAL} AND {SB_VAL}'
     stat_cond = base_cond2 + f' AND action_id >= {FOLD_VAL}'
-    calc_action(conn, 'n_rfi_bb', stat_cond, join_p_hands=True)
+    add_stat(registry, 'n_rfi_bb', 'action', stat_cond, join='p_hands')
     
     # Raise first in from BB (open preflop with a raise)
     stat_cond = base_cond2 + f' AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'rfi_bb', stat_cond, join_p_hands=True)
+    add_stat(registry, 'rfi_bb', 'action', stat_cond, join='p_hands')
 
     # All potential raise first in from SB (opp to open preflop)
     base_cond2 = base_cond + f' AND pos > {SB_VAL}'
     stat_cond = base_cond2 + f' AND action_id >= {FOLD_VAL}'
-    calc_action(conn, 'n_rfi_sb', stat_cond, join_p_hands=True)
+    add_stat(registry, 'n_rfi_sb', 'action', stat_cond, join='p_hands')
     
     # Raise first in from SB (open preflop with a raise)
     stat_cond = base_cond2 + f' AND action_id = {RAISE_VAL}'
-    calc_action(conn, 'rfi_sb', stat_cond, join_p_hands=True)
+    add_stat(registry, 'rfi_sb', 'action', stat_cond, join='p_hands')
 
+    return registry
 
-def run_win_stats(conn):
-    '''Helper method for calling each of the winning stats methods.'''
+
+def register_win_stats(registry):
+    '''Adds each of the winning stats to the stat registry.'''
     
     # All potential won when seeing flop (took action on flop)
     # needs to check if player was active on flop, not took action (player could be all-in preflop) XXX
     base_cond = f'street = {FLOP_VAL}'
-    calc_action(conn, 'n_wwsf', base_cond)
+    add_stat(registry, 'n_wwsf', 'action', base_cond)
     
     # Won when seeing flop
     # p. 225
     stat_cond = base_cond + ' AND balance > 0'
-    calc_action(conn, 'wwsf', stat_cond, join_p_hands=True)
+    add_stat(registry, 'wwsf', 'action', stat_cond, join='p_hands')
     
     # All went to showdown
     # Already in stats as saw_sd
@@ -869,238 +1850,833 @@ def run_win_stats(conn):
     # Should this count a pure chop (balance == 0)? XXX
     # p. 137
     stat_cond = 'saw_sd = 1 AND balance > 0'
-    calc_action(conn, 'won_sd', stat_cond, join_p_hands=True)
+    add_stat(registry, 'won_sd', 'action', stat_cond, join='p_hands')
     
     # All potential showed cards with win (won without showdown)
     base_cond = 'saw_sd = 0 AND balance > 0'
-    calc_action(conn, 'n_show', base_cond, join_p_hands=True)
+    add_stat(registry, 'n_show', 'action', base_cond, join='p_hands')
     
     # Showed cards with win (won without showdown and cards are known)
     stat_cond = base_cond + ' AND card1 IS NOT NULL AND card2 IS NOT NULL'
-    calc_action(conn, 'show', stat_cond, join_p_hands=True)
+    add_stat(registry, 'show', 'action', stat_cond, join='p_hands')
     
     # stack size in terms of BB
-    subq = 'SELECT * FROM PlayerHands JOIN Hands USING (table_id, hand_num)'
-    set_value(conn, 'stack_bb', 'other.stack / (other.bb_amt * 1.0)', subq)
+    subq = ('SELECT * FROM PlayerHands JOIN Hands USING (table_id, hand_num)'
+            + ' WHERE (table_id, hand_num) IN NewHands')
+    add_stat(registry, 'stack_bb', 'value', subq, val='other.stack / (other.bb_amt * 1.0)')
 
     # balance in terms of BB
-    set_value(conn, 'balance_bb', 'other.balance / (other.bb_amt * 1.0)', subq)
+    add_stat(registry, 'balance_bb', 'value', subq, val='other.balance / (other.bb_amt * 1.0)')
+
+    return registry
 
 
-def run_agg_stats(conn):
-    '''Helper method for calling each of the aggression stats methods.'''
+def register_agg_stats(registry):
+    '''Adds each of the aggression stats to the stat registry.'''
     
     # All potential preflop limp-raises (opp to call then raise preflop)
-    base_cond = (f'street = {PREFLOP_VAL} and a1.action_id = {CALL_VAL}'
-                 + ' AND a1.bet_level <= 1')
-    stat_cond = base_cond + f' AND a2.action_id >= {FOLD_VAL}'
-    calc_seq_action(conn, 'n_limpr', stat_cond)
+    first_cond = f'action_id = {CALL_VAL} AND bet_level <= 1'
+    base_cond = f'street = {PREFLOP_VAL}'
+    stat_cond = base_cond + f' AND action_id >= {FOLD_VAL}'
+    add_stat(registry, 'n_limpr', 'seq', stat_cond, first_cond=first_cond, street=PREFLOP_VAL)
 
     # Preflop limp-raise (call then raise preflop)
-    stat_cond = base_cond + f' AND a2.action_id = {RAISE_VAL}'
-    calc_seq_action(conn, 'limpr', stat_cond)
+    stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
+    add_stat(registry, 'limpr', 'seq', stat_cond, first_cond=first_cond, street=PREFLOP_VAL)
 
     # All potential flop check-raises
+    first_cond = f'action_id = {CHECK_VAL}'
     street_cond = f'street = {FLOP_VAL}'
-    base_cond = f' AND a1.action_id = {CHECK_VAL}'
-    base_cond2 = f' AND a2.action_id >= {FOLD_VAL}'
-    stat_cond = street_cond + base_cond + base_cond2
-    calc_seq_action(conn, 'n_cr_flop', stat_cond)
+    base_cond2 = f' AND action_id >= {FOLD_VAL}'
+    stat_cond = street_cond + base_cond2
+    add_stat(registry, 'n_cr_flop', 'seq', stat_cond, first_cond=first_cond, street=FLOP_VAL)
     
     # Flop check-raise
-    base_cond3 = f' AND a2.action_id = {RAISE_VAL}'
-    stat_cond = street_cond + base_cond + base_cond3
-    calc_seq_action(conn, 'cr_flop', stat_cond)
+    base_cond3 = f' AND action_id = {RAISE_VAL}'
+    stat_cond = street_cond + base_cond3
+    add_stat(registry, 'cr_flop', 'seq', stat_cond, first_cond=first_cond, street=FLOP_VAL)
     
     # All potential turn check-raises
     street_cond = f'street = {TURN_VAL}'
-    stat_cond = street_cond + base_cond + base_cond2
-    calc_seq_action(conn, 'n_cr_turn', stat_cond)
+    stat_cond = street_cond + base_cond2
+    add_stat(registry, 'n_cr_turn', 'seq', stat_cond, first_cond=first_cond, street=TURN_VAL)
     
     # Turn check-raise
-    stat_cond = street_cond + base_cond + base_cond3
-    calc_seq_action(conn, 'cr_turn', stat_cond)
+    stat_cond = street_cond + base_cond3
+    add_stat(registry, 'cr_turn', 'seq', stat_cond, first_cond=first_cond, street=TURN_VAL)
 
     # All potential river check-raises
     street_cond = f'street = {RIVER_VAL}'
-    stat_cond = street_cond + base_cond + base_cond2
-    calc_seq_action(conn, 'n_cr_river', stat_cond)
+    stat_cond = street_cond + base_cond2
+    add_stat(registry, 'n_cr_river', 'seq', stat_cond, first_cond=first_cond, street=RIVER_VAL)
     
     # River check-raise
-    stat_cond = street_cond + base_cond + base_cond3
-    calc_seq_action(conn, 'cr_river', stat_cond)
+    stat_cond = street_cond + base_cond3
+    add_stat(registry, 'cr_river', 'seq', stat_cond, first_cond=first_cond, street=RIVER_VAL)
     
     # All potential flop check-raise cbets (opp to check then raise as pfr)
     # Alternatively, n_cbet_flop = 1 and n_cr_flop = 1
-    base_cond = (f'street = {FLOP_VAL} AND a1.bet_level = 0'
-                 + f' AND a1.player_id = pf_agg_id AND a1.action_id = {CHECK_VAL}')
-    stat_cond = base_cond + f' AND a2.action_id >= {FOLD_VAL}'
-    calc_seq_action(conn, 'n_cr_cbet_flop', stat_cond, join_hands=True)
+    first_cond = (f'bet_level = 0 AND player_id = pf_agg_id'
+                  + f' AND action_id = {CHECK_VAL}')
+    base_cond = f'street = {FLOP_VAL}'
+    stat_cond = base_cond + f' AND action_id >= {FOLD_VAL}'
+    add_stat(registry, 'n_cr_cbet_flop', 'seq', stat_cond, first_cond=first_cond, join='hands',
+             street=FLOP_VAL)
     
     # Flop check-raise cbets (check then raise as pfr)
     # Alternatively, n_cbet_flop = 1 and cr_flop = 1
-    stat_cond = base_cond + f' AND a2.action_id = {RAISE_VAL}'
-    calc_seq_action(conn, 'cr_cbet_flop', stat_cond, join_hands=True)
+    stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
+    add_stat(registry, 'cr_cbet_flop', 'seq', stat_cond, first_cond=first_cond, join='hands',
+             street=FLOP_VAL)
     
     # All potential check-raise cbets on any street
     base_cond = ('(n_cbet_flop = 1 AND n_cr_flop = 1)'
                  + ' OR (n_cbet_turn = 1 AND n_cr_turn = 1)'
                  + ' OR (n_cbet_river = 1 AND n_cr_river = 1)')
-    calc_action(conn, 'n_cr_cbet_any', 'True', base_cond)
+    add_stat(registry, 'n_cr_cbet_any', 'derived', base_cond,
+             deps=['n_cbet_flop', 'n_cbet_turn', 'n_cbet_river',
+                   'n_cr_flop', 'n_cr_turn', 'n_cr_river'])
     
     # Check-raise cbet on any street
     base_cond = ('(n_cbet_flop = 1 AND cr_flop = 1)'
                  + ' OR (n_cbet_turn = 1 AND cr_turn = 1)'
                  + ' OR (n_cbet_river = 1 AND cr_river = 1)')
-    calc_action(conn, 'cr_cbet_any', 'True', base_cond)
+    add_stat(registry, 'cr_cbet_any', 'derived', base_cond,
+             deps=['n_cbet_flop', 'n_cbet_turn', 'n_cbet_river',
+                   'cr_flop', 'cr_turn', 'cr_river'])
+
+    return registry
 
 
-def run_counting_stats(conn):
-    '''Helper method for calling each of the counting stats methods.'''
+def register_counting_stats(registry):
+    '''Adds each of the counting stats to the stat registry.'''
 
     # All postflop actions
     base_cond = f'street >= {FLOP_VAL}'
     stat_cond = base_cond + f' AND action_id >= {FOLD_VAL}'
-    count_action(conn, 'n_actions', stat_cond)
+    add_stat(registry, 'n_actions', 'count', stat_cond)
 
     # Postflop folds
     stat_cond = base_cond + f' AND action_id = {FOLD_VAL}'
-    count_action(conn, 'n_folds', stat_cond)
+    add_stat(registry, 'n_folds', 'count', stat_cond)
 
     # Postflop checks
     stat_cond = base_cond + f' AND action_id = {CHECK_VAL}'
-    count_action(conn, 'n_checks', stat_cond)
+    add_stat(registry, 'n_checks', 'count', stat_cond)
 
     # Postflop calls
     stat_cond = base_cond + f' AND action_id = {CALL_VAL}'
-    count_action(conn, 'n_calls', stat_cond)
+    add_stat(registry, 'n_calls', 'count', stat_cond)
     
     # Postflop bets
     stat_cond = base_cond + f' AND action_id = {BET_VAL}'
-    count_action(conn, 'n_bets', stat_cond)
+    add_stat(registry, 'n_bets', 'count', stat_cond)
     
     # Postflop raises
     stat_cond = base_cond + f' AND action_id = {RAISE_VAL}'
-    count_action(conn, 'n_raises', stat_cond)
+    add_stat(registry, 'n_raises', 'count', stat_cond)
     
     # Postflop check-raises. Counting stat for convenience;
     # should generally use dedicated check-raise stats.
     # Number not subtracted from raw check or raise totals.
     stat_cond = base_cond + (f' AND prev_act_id = {CHECK_VAL}'
                              + f' AND action_id = {RAISE_VAL}')
-    count_action(conn, 'n_check_rs', stat_cond)
-    
+    add_stat(registry, 'n_check_rs', 'count', stat_cond)
+
+    return registry
+
+
+def register_action_codes(registry):
+    '''Adds the action codes for each street to the stat registry (see code_batch).
+    Pattern stats can match these instead of joining Actions to itself, e.g.
+    act_flop GLOB 'XR*' for a check-raise or act_pf = 'CF' for a limp-fold.'''
+
+    for (street_name, street_val) in [('pf', PREFLOP_VAL), ('flop', FLOP_VAL),
+                                      ('turn', TURN_VAL), ('river', RIVER_VAL)]:
+        add_stat(registry, f'act_{street_name}', 'codes', f'street = {street_val}')
+
+    return registry
+
+
+def build_stat_registry():
+    '''Builds the stat registry of all StatPlayerHands helper variables
+    (see the register_ methods for stat descriptions).'''
+
+    registry = []
+    register_preflop_stats(registry)
+    register_cbet_stats(registry)
+    register_stab_stats(registry)
+    register_rfi_stats(registry)
+    register_win_stats(registry)
+    register_agg_stats(registry)
+    register_counting_stats(registry)
+    register_action_codes(registry)
+
+    return registry
+
+
+def replay_columns():
+    '''Returns the list of StatPlayerHands columns calculated by the replay engine
+    (see replay_hand); the counting stats are last.'''
+
+    col_list = ['vpip', 'pfr', 'n_threebet', 'threebet', 'n_fourbet', 'fourbet',
+                'n_face3bet', 'rr3bet', 'call3bet', 'foldto3bet', 'n_face4bet', 'foldto4bet',
+                'n_callopen', 'callopen']
+    for street_name in ['flop', 'turn', 'river']:
+        col_list += [f'n_cbet_{street_name}', f'cbet_{street_name}',
+                     f'n_faced_cbet_{street_name}', f'foldto_cbet_{street_name}',
+                     f'n_stab_{street_name}', f'stab_{street_name}',
+                     f'n_donk_{street_name}', f'donk_{street_name}',
+                     f'n_cr_{street_name}', f'cr_{street_name}']
+    col_list += ['raise_cbet_flop', 'n_faced_3cbet_flop', 'foldto_3cbet_flop']
+    col_list += ['n_rfi', 'rfi']
+    for pos_index in range(POS_MIN, POS_MAX + 1):
+        col_list += [f'n_rfi_{pos_index}', f'rfi_{pos_index}']
+    col_list += ['n_rfi_bb', 'rfi_bb', 'n_rfi_sb', 'rfi_sb']
+    col_list += ['n_wwsf', 'wwsf', 'won_sd', 'n_show', 'show', 'stack_bb', 'balance_bb']
+    col_list += ['n_limpr', 'limpr', 'n_cr_cbet_flop', 'cr_cbet_flop', 'n_cr_cbet_any', 'cr_cbet_any']
+    col_list += ['n_actions', 'n_folds', 'n_checks', 'n_calls', 'n_bets', 'n_raises', 'n_check_rs']
+
+    return col_list
+
+
+def replay_hand(hand, ph_dict, action_list):
+    '''Replays one hand and returns its StatPlayerHands values as a dict of
+    {player_id: {column: value}}, with the same results as the stat registry
+    (see the register_ methods for stat descriptions).
+    (hand) is a tuple of (pf_agg_id, flop_agg_id, turn_agg_id, pf_bet_level, bb_amt),
+    or None if the hand is missing from Hands.
+    (ph_dict) is {player_id: (pos, stack, balance, saw_sd, card1, card2)} from PlayerHands.
+    (action_list) is a list of (player_id, street, action_id, bet_level, agg_id,
+    prev_act_id, n_commit) tuples in action_num order.
+    As in SQL, comparisons with None (NULL) are never true.'''
+
+    col_list = replay_columns()
+    street_dict = {FLOP_VAL: 'flop', TURN_VAL: 'turn', RIVER_VAL: 'river'}
+    if hand is None:
+        (pf_agg_id, flop_agg_id, turn_agg_id, pf_bet_level, bb_amt) = (None,) * 5
+    else:
+        (pf_agg_id, flop_agg_id, turn_agg_id, pf_bet_level, bb_amt) = hand
+    # aggressor of the previous street, for cbets, stabs, and donks
+    prev_agg_dict = {FLOP_VAL: pf_agg_id, TURN_VAL: flop_agg_id, RIVER_VAL: turn_agg_id}
+
+    def new_row():
+        row = dict.fromkeys(col_list)
+        for col in col_list[-7:]:
+            row[col] = 0
+        return row
+
+    # stack size and balance in terms of BB for every player
+    row_dict = {}
+    for (player_id, (pos, stack, balance, saw_sd, card1, card2)) in ph_dict.items():
+        row = new_row()
+        if hand is not None and bb_amt:
+            if stack is not None:
+                row['stack_bb'] = stack / (bb_amt * 1.0)
+            if balance is not None:
+                row['balance_bb'] = balance / (bb_amt * 1.0)
+        row_dict[player_id] = row
+
+    # earlier actions on the same street, for the sequential stats:
+    # kinds of earlier actions by each player, and streets where the previous aggressor checked
+    earlier_dict = {}
+    agg_checked = set()
+    donk_set = set()
+    for (player_id, street, action_id, bet_level, agg_id, prev_act_id, n_commit) in action_list:
+        if player_id not in row_dict:
+            row_dict[player_id] = new_row()
+        row = row_dict[player_id]
+        ph = ph_dict.get(player_id)
+        earlier = earlier_dict.setdefault((street, player_id), set())
+        is_fold = action_id == FOLD_VAL
+        is_call = action_id == CALL_VAL
+        is_bet = action_id == BET_VAL
+        is_raise = action_id == RAISE_VAL
+        not_post = action_id is not None and action_id >= FOLD_VAL
+        prev_agg_id = prev_agg_dict.get(street)
+
+        if street == PREFLOP_VAL:
+            if action_id is not None and action_id >= CALL_VAL:
+                row['vpip'] = 1
+            if is_raise:
+                row['pfr'] = 1
+            if bet_level == 2:
+                row['n_threebet'] = 1
+                if is_raise:
+                    row['threebet'] = 1
+            if bet_level == 3:
+                row['n_fourbet'] = 1
+                if is_raise:
+                    row['fourbet'] = 1
+            if hand is not None and bet_level == 3 and 'open' in earlier:
+                row['n_face3bet'] = 1
+                for (col, flag) in [('rr3bet', is_raise), ('call3bet', is_call), ('foldto3bet', is_fold)]:
+                    if flag:
+                        row[col] = 1
+            if hand is not None and bet_level == 4 and 'threebet' in earlier:
+                row['n_face4bet'] = 1
+                if is_fold:
+                    row['foldto4bet'] = 1
+            if ph is not None and bet_level == 2 and n_commit is not None and n_commit <= 1 \
+                    and ph[0] is not None and (ph[0] < BB_VAL or ph[0] >= SB_VAL):
+                row['n_callopen'] = 1
+                if is_call:
+                    row['callopen'] = 1
+            if bet_level == 0:
+                if not_post:
+                    row['n_rfi'] = 1
+                if is_raise:
+                    row['rfi'] = 1
+                pos = None if ph is None else ph[0]
+                if pos is not None:
+                    pos_list = [str(pos_index) for pos_index in range(POS_MIN, POS_MAX + 1)
+                                if pos == pos_index]
+                    if BB_VAL <= pos <= SB_VAL:
+                        pos_list.append('bb')
+                    if pos > SB_VAL:
+                        pos_list.append('sb')
+                    for pos_str in pos_list:
+                        if not_post:
+                            row[f'n_rfi_{pos_str}'] = 1
+                        if is_raise:
+                            row[f'rfi_{pos_str}'] = 1
+            if hand is not None and not_post and 'limp' in earlier:
+                row['n_limpr'] = 1
+                if is_raise:
+                    row['limpr'] = 1
+
+        elif street in street_dict:
+            street_name = street_dict[street]
+            if hand is not None and bet_level == 0 and prev_agg_id is not None:
+                if player_id == prev_agg_id:
+                    row[f'n_cbet_{street_name}'] = 1
+                    if is_bet:
+                        row[f'cbet_{street_name}'] = 1
+                elif player_id is not None:
+                    donk_set.add((player_id, street_name, is_bet))
+            if hand is not None and bet_level == 1 and agg_id is not None and agg_id == prev_agg_id:
+                row[f'n_faced_cbet_{street_name}'] = 1
+                if is_fold:
+                    row[f'foldto_cbet_{street_name}'] = 1
+                if street == FLOP_VAL:
+                    if is_raise:
+                        row['raise_cbet_flop'] = 1
+                    if pf_bet_level == 3:
+                        row['n_faced_3cbet_flop'] = 1
+                        if is_fold:
+                            row['foldto_3cbet_flop'] = 1
+            if hand is not None and bet_level == 0 and street in agg_checked:
+                row[f'n_stab_{street_name}'] = 1
+                if is_bet:
+                    row[f'stab_{street_name}'] = 1
+            if hand is not None and not_post and 'check' in earlier:
+                row[f'n_cr_{street_name}'] = 1
+                if is_raise:
+                    row[f'cr_{street_name}'] = 1
+            if hand is not None and street == FLOP_VAL and not_post and 'agg_check' in earlier:
+                row['n_cr_cbet_flop'] = 1
+                if is_raise:
+                    row['cr_cbet_flop'] = 1
+
+        # winning stats
+        if street == FLOP_VAL:
+            row['n_wwsf'] = 1
+        if ph is not None and ph[2] is not None and ph[2] > 0:
+            if street == FLOP_VAL:
+                row['wwsf'] = 1
+            if ph[3] == 1:
+                row['won_sd'] = 1
+            if ph[3] == 0:
+                row['n_show'] = 1
+                if ph[4] is not None and ph[5] is not None:
+                    row['show'] = 1
+
+        # counting stats
+        if hand is not None and street is not None and street >= FLOP_VAL:
+            for (col, flag) in [('n_actions', not_post), ('n_folds', is_fold),
+                                ('n_checks', action_id == CHECK_VAL), ('n_calls', is_call),
+                                ('n_bets', is_bet), ('n_raises', is_raise),
+                                ('n_check_rs', is_raise and prev_act_id == CHECK_VAL)]:
+                if flag:
+                    row[col] += 1
+
+        # remember this action for later actions on the same street
+        if is_raise and bet_level is not None and bet_level <= 1:
+            earlier.add('open')
+        if is_raise and bet_level == 2:
+            earlier.add('threebet')
+        if is_call and bet_level is not None and bet_level <= 1:
+            earlier.add('limp')
+        if action_id == CHECK_VAL:
+            earlier.add('check')
+            if bet_level == 0 and player_id is not None and player_id == pf_agg_id:
+                earlier.add('agg_check')
+            if player_id is not None and player_id == prev_agg_id:
+                agg_checked.add(street)
+
+    # donks are only counted when there was no chance to stab
+    for (player_id, street_name, is_bet) in donk_set:
+        row = row_dict[player_id]
+        if row[f'n_stab_{street_name}'] is None:
+            row[f'n_donk_{street_name}'] = 1
+            if is_bet:
+                row[f'donk_{street_name}'] = 1
+
+    # check-raise cbets on any street, for players with actions
+    for player_id in {action[0] for action in action_list}:
+        row = row_dict[player_id]
+        for (col, cr_str) in [('n_cr_cbet_any', 'n_cr'), ('cr_cbet_any', 'cr')]:
+            if any(row[f'n_cbet_{street_name}'] == 1 and row[f'{cr_str}_{street_name}'] == 1
+                   for street_name in street_dict.values()):
+                row[col] = 1
+
+    return row_dict
+
+
+def replay_new_hands(conn):
+    '''Generator that streams the new hands (NewHands) in (table_id, hand_num) order,
+    with one sequential read of NewActions and one of PlayerHands.
+    Yields (table_id, hand_num, hand, ph_dict, action_list) tuples for replay_hand().'''
+
+    action_cur = conn.cursor()
+    query = '''SELECT table_id, hand_num, player_id, street, action_id, bet_level, agg_id,
+        prev_act_id, n_commit
+        FROM NewActions
+        ORDER BY table_id, hand_num, action_num'''
+    action_cur.execute(query)
+
+    ph_cur = conn.cursor()
+    query = '''SELECT table_id, hand_num, Hands.hand_num IS NOT NULL,
+        pf_agg_id, flop_agg_id, turn_agg_id, pf_bet_level, bb_amt,
+        player_id, pos, stack, balance, saw_sd, card1, card2
+        FROM PlayerHands LEFT JOIN Hands USING (table_id, hand_num)
+        WHERE (table_id, hand_num) IN NewHands
+        ORDER BY table_id, hand_num'''
+    ph_cur.execute(query)
+    ph_groups = itertools.groupby(ph_cur, key=lambda row: row[:2])
+    ph_key = None
+
+    for (key, action_iter) in itertools.groupby(action_cur, key=lambda row: row[:2]):
+        # both cursors are in the same order
+        while ph_key is None or ph_key < key:
+            (ph_key, ph_iter) = next(ph_groups, (key, iter(())))
+        ph_list = list(ph_iter) if ph_key == key else []
+        hand = None
+        if ph_list and ph_list[0][2]:
+            hand = ph_list[0][3:8]
+        ph_dict = {row[8]: row[9:] for row in ph_list}
+        yield (key[0], key[1], hand, ph_dict, [row[2:] for row in action_iter])
+
+    action_cur.close()
+    ph_cur.close()
+
+
+def run_replay_engine(conn, registry):
+    '''Calculates the registered stats (registry) for the new hands with the replay engine:
+    each hand is replayed in Python (see replay_hand) and the StatPlayerHands rows
+    are written with batched executemany.
+    Returns the list of stats that were calculated.'''
+
+    col_list = [col for col in replay_columns() if col in {stat['name'] for stat in registry}]
+    print('replay', end=' ')
+    begin_time = time.perf_counter()
+
+    cur = conn.cursor()
+    query = ('UPDATE StatPlayerHands SET ' + ', '.join([f'{col} = ?' for col in col_list])
+             + ' WHERE table_id = ? AND hand_num = ? AND player_id = ? AND date_added IS NULL')
+
+    num_rows = 0
+    row_list = []
+    for (table_id, hand_num, hand, ph_dict, action_list) in replay_new_hands(conn):
+        for (player_id, row) in replay_hand(hand, ph_dict, action_list).items():
+            row_list.append([row[col] for col in col_list] + [table_id, hand_num, player_id])
+        if len(row_list) >= 10000:
+            cur.executemany(query, row_list)
+            num_rows += len(row_list)
+            row_list = []
+    cur.executemany(query, row_list)
+    num_rows += len(row_list)
+
+    if PROFILE:
+        query_log.append({'label': 'replay', 'seconds': round(time.perf_counter() - begin_time, 6),
+                          'rows': num_rows, 'sql': query, 'plan': ''})
+
+    commit_stats(conn)
+    cur.close()
+
+    return col_list
+
+
+def check_replay_engine(conn, registry):
+    '''Compares the replay engine (see replay_hand) with the StatPlayerHands values
+    calculated by the stat registry (registry) for the new hands, and prints the
+    columns that do not match. Does not change the database.'''
+
+    col_list = [col for col in replay_columns() if col in {stat['name'] for stat in registry}]
+    print()
+    print('Checking replay engine...')
+
+    cur = conn.cursor()
+    query = (f'SELECT table_id, hand_num, player_id, {", ".join(col_list)}'
+             + ' FROM StatPlayerHands'
+             + ' WHERE (table_id, hand_num) IN NewHands AND date_added IS NULL')
+    cur.execute(query)
+    sql_dict = {row[:3]: row[3:] for row in cur.fetchall()}
+    cur.close()
+
+    num_rows = 0
+    diff_dict = {}
+    for (table_id, hand_num, hand, ph_dict, action_list) in replay_new_hands(conn):
+        for (player_id, row) in replay_hand(hand, ph_dict, action_list).items():
+            sql_row = sql_dict.get((table_id, hand_num, player_id))
+            if sql_row is None:
+                continue
+            num_rows += 1
+            for (col, sql_val) in zip(col_list, sql_row):
+                if row[col] != sql_val:
+                    diff_dict.setdefault(col, []).append((table_id, hand_num, player_id, sql_val, row[col]))
+
+    if not diff_dict:
+        print(f'...Replay engine matches SQL for {num_rows} rows')
+    for (col, diff_list) in diff_dict.items():
+        print(f'...{col} differs in {len(diff_list)} rows, e.g. (table_id, hand_num, player_id, SQL, replay):'
+              + f' {diff_list[0]}')
+
+
+def run_hand_stats(conn, registry):
+    '''Calculates the registered stats (registry) for the new hands with the engine
+    set by STATS_ENGINE: 'sql' runs the stat registry, 'replay' runs the replay
+    engine, and 'check' runs the stat registry and then checks the replay engine.'''
+
+    if STATS_ENGINE == 'replay':
+        with stat_group(conn, 'replay_stats'):
+            col_list = run_replay_engine(conn, registry)
+        # stats added to the registry without a replay version
+        run_stat_registry(conn, registry, skip=col_list)
+    else:
+        run_stat_registry(conn, registry)
+        if STATS_ENGINE == 'check':
+            check_replay_engine(conn, registry)
+
 
 def run_pvp_stats(conn):
-    '''Calculates PvP nemesis-hero stats.'''
+    '''Calculates PvP nemesis-hero stats.
+    Each loser's loss is split between the winners in proportion to their
+    winnings, and recorded for both the winner and the loser.
+    All winner/loser pairs are inserted with one set-based query;
+    re-running a hand replaces its existing rows.'''
     
     print('PvP', end=' ')
     
     cur = conn.cursor()
-    
-    query = '''SELECT table_id, hand_num, player_id, balance, bb_amt,
-        (SELECT SUM(balance)
-            FROM PlayerHands AS ph2
-            WHERE ph1.table_id = ph2.table_id AND ph1.hand_num = ph2.hand_num
-            AND balance > 0
-            GROUP BY table_id, hand_num) AS balance_sum
-        FROM PlayerHands AS ph1 JOIN Hands USING (table_id, hand_num)
-        WHERE (table_id, hand_num) IN NewHands
-        AND balance > 0
-        ORDER BY table_id, hand_num, player_id'''
-        
-    winner_hands = cur.execute(query).fetchall()
-    
-    for winner_hand in winner_hands:
-        # print("Winner:", winner_hand)
-        (table_id, hand_num, winner_id, winner_balance,
-         bb_amt, balance_sum) = winner_hand
 
-        query = '''SELECT player_id, balance
-            FROM PlayerHands
-            WHERE table_id = ? AND hand_num = ?
-            AND balance < 0
-            ORDER BY player_id'''
-            
-        values = (table_id, hand_num)
-        loser_hands = cur.execute(query, values).fetchall()
-        
-        for loser_hand in loser_hands:
-            # print("...loser:", loser_hand)
-            (loser_id, loser_balance) = loser_hand
-            # hacky way to distribute losses when there are multiple winners
-            loser_balance = loser_balance * (winner_balance / balance_sum)
-            
-            # set winner as gaining -loser_balance from loser
-            query = '''INSERT INTO StatPvP
-                (table_id, hand_num, player_id, opp_id, net_chips, net_bb)
-                VALUES (?, ?, ?, ?, ?, ?)'''
-            values = (table_id, hand_num, winner_id, loser_id,
-                      -loser_balance, -loser_balance / bb_amt)
-            cur.execute(query, values)
-            
-            # set loser as losing loser_balance to winner
-            query = '''INSERT INTO StatPvP
-                (table_id, hand_num, player_id, opp_id, net_chips, net_bb)
-                VALUES (?, ?, ?, ?, ?, ?)'''
-            values = (table_id, hand_num, loser_id, winner_id,
-                      loser_balance, loser_balance / bb_amt)
-            cur.execute(query, values)
+    '''
+    The general form of the query is
+     WITH Winners AS (winners in new hands with their share of total winnings),
+      Pairs AS (Winners JOIN losers in the same hand)
+     INSERT OR REPLACE INTO StatPvP
+     SELECT <winner gains -loser_balance from loser> FROM Pairs
+     UNION ALL
+     SELECT <loser loses loser_balance to winner> FROM Pairs
+    '''
     
+    # hacky way to distribute losses when there are multiple winners:
+    # loser_balance * (winner_balance / balance_sum)
+    query = '''WITH Winners AS
+        (SELECT table_id, hand_num, player_id, bb_amt,
+         balance * 1.0 / SUM(balance) OVER (PARTITION BY table_id, hand_num) AS share
+         FROM PlayerHands JOIN Hands USING (table_id, hand_num)
+         WHERE (table_id, hand_num) IN NewHands
+         AND balance > 0),
+        Pairs AS
+        (SELECT w.table_id, w.hand_num, w.player_id AS winner_id,
+         l.player_id AS loser_id, l.balance * w.share AS loser_balance, w.bb_amt
+         FROM Winners AS w JOIN PlayerHands AS l
+         ON w.table_id = l.table_id AND w.hand_num = l.hand_num
+         WHERE l.balance < 0)
+        INSERT OR REPLACE INTO StatPvP
+        (table_id, hand_num, player_id, opp_id, net_chips, net_bb)
+        SELECT table_id, hand_num, winner_id, loser_id,
+         -loser_balance, -loser_balance / bb_amt
+        FROM Pairs
+        UNION ALL
+        SELECT table_id, hand_num, loser_id, winner_id,
+         loser_balance, loser_balance / bb_amt
+        FROM Pairs'''
+    execute_query(cur, query, label='PvP')
+    
+    commit_stats(conn)
+    cur.close()
+
+
+def load_memory_tables(mem_conn, table_range=None):
+    '''Loads the new hands from the database attached as 'disk' into the
+    in-memory database (mem_conn): its own NewActions and NewHands, along with
+    the new hands' rows from Hands, PlayerHands, and StatPlayerHands, and an
+    empty StatPvP. Optional (table_range) limits the new hands to a
+    (first, last) tuple of table_ids (see run_stats_shard).'''
+
+    mem_cur = mem_conn.cursor()
+
+    # tables are not in main yet, so these select from the attached database
+    create_new_actions_table(mem_conn, table_range=table_range)
+    create_new_hands_table(mem_conn)
+
+    # same tables and indexes as on disk, with only the new hands
+    table_list = ['Hands', 'PlayerHands', 'StatPlayerHands', 'StatPvP']
+    query = f'''SELECT type, name, sql FROM disk.sqlite_master
+            WHERE type IN ('table', 'index') AND sql IS NOT NULL
+            AND tbl_name IN ({', '.join('?' * len(table_list))})
+            ORDER BY type != 'table', name'''
+    mem_cur.execute(query, table_list)
+    for (object_type, name, sql) in mem_cur.fetchall():
+        mem_cur.execute(sql)
+        if object_type != 'table' or name == 'StatPvP':
+            continue
+        mem_cur.execute(f'''INSERT INTO main.{name} SELECT * FROM disk.{name}
+                        WHERE (table_id, hand_num) IN NewHands''')
+        print(f'...Loaded {mem_cur.rowcount} rows from {name}')
+    mem_conn.commit()
+
+    mem_cur.close()
+
+
+def merge_stats(cur, target, sph_source, pvp_source):
+    '''Copies calculated stats into StatPlayerHands and StatPvP of the database
+    (target), e.g. 'main' or 'disk', from tables with the same columns
+    (sph_source, pvp_source), e.g. 'main.StatPlayerHands'.
+    row_num is left to run_final_stats.'''
+
+    '''
+    The general form of the query is
+     UPDATE target.StatPlayerHands AS sph SET (<stat cols>) = (<source stat cols>)
+     FROM sph_source AS src
+     WHERE <sph and src are the same row>
+    '''
+
+    key_list = ['table_id', 'hand_num', 'player_id']
+    cur.execute(f'PRAGMA {target}.table_info(StatPlayerHands)')
+    col_list = [row[1] for row in cur.fetchall() if row[1] not in key_list + ['row_num']]
+    query = f'UPDATE {target}.StatPlayerHands AS sph SET (' + ', '.join(col_list) + ') = (' \
+        + ', '.join(['src.' + col for col in col_list]) + f''')
+        FROM {sph_source} AS src
+        WHERE ''' + ' AND '.join([f'sph.{col} = src.{col}' for col in key_list])
+    execute_query(cur, query, label='merge_StatPlayerHands')
+    query = f'INSERT OR REPLACE INTO {target}.StatPvP SELECT * FROM {pvp_source}'
+    execute_query(cur, query, label='merge_StatPvP')
+
+
+def run_memory_stats(conn, db_name):
+    '''Calculates the registered stats and PvP stats for the new hands in an
+    in-memory database, then merges the results back into (db_name) in one
+    transaction. The in-memory database gets its own NewActions and NewHands
+    along with the new hands' rows from Hands, PlayerHands, and StatPlayerHands,
+    so the stats queries never touch the full tables on disk.
+    Final, rollup, and tournament stats need every hand, so they still run on (conn).'''
+
+    # release any locks so the in-memory connection can read and write the file
+    conn.commit()
+
+    mem_conn = sqlite3.connect(':memory:')
+    mem_cur = mem_conn.cursor()
+    mem_cur.execute('PRAGMA temp_store = MEMORY')
+    mem_cur.execute('ATTACH DATABASE ? AS disk', (db_name,))
+
+    print('Loading new hands into memory...')
+    load_memory_tables(mem_conn)
+
+    # calculate all registered stats
+    run_hand_stats(mem_conn, build_stat_registry())
+    with stat_group(mem_conn, 'pvp_stats'):
+        run_pvp_stats(mem_conn)
+    mem_conn.commit()
+
+    print()
+    print('Merging stats from memory...')
+    merge_stats(mem_cur, 'disk', 'main.StatPlayerHands', 'main.StatPvP')
+    mem_conn.commit()
+
+    mem_cur.close()
+    mem_conn.close()
+
+
+def run_stats_shard(db_name, table_range, shard_name):
+    '''Calculates the registered stats and PvP stats in a worker process for
+    the new hands in one shard of (db_name), a (first, last) tuple of table_ids
+    (table_range). The database is opened read-only and the stats are calculated
+    in memory (see run_memory_stats), then the shard's StatPlayerHands and StatPvP
+    rows are written to the file (shard_name) for the writer (see run_sharded_stats).
+    Returns a tuple of (shard_name, number of rows, profiled queries).'''
+
+    # workers' output would be interleaved, so only the writer prints
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        query_log.clear()
+        mem_conn = sqlite3.connect('file::memory:', uri=True)
+        mem_cur = mem_conn.cursor()
+        mem_cur.execute('PRAGMA temp_store = MEMORY')
+        mem_cur.execute('ATTACH DATABASE ? AS disk',
+                        (pathlib.Path(db_name).absolute().as_uri() + '?mode=ro',))
+        load_memory_tables(mem_conn, table_range)
+
+        run_hand_stats(mem_conn, build_stat_registry())
+        with stat_group(mem_conn, 'pvp_stats'):
+            run_pvp_stats(mem_conn)
+        mem_conn.commit()
+
+        mem_cur.execute('ATTACH DATABASE ? AS shard', (shard_name,))
+        mem_cur.execute('CREATE TABLE shard.StatPlayerHands AS SELECT * FROM main.StatPlayerHands')
+        mem_cur.execute('SELECT COUNT(*) FROM shard.StatPlayerHands')
+        num_rows = mem_cur.fetchone()[0]
+        mem_cur.execute('CREATE TABLE shard.StatPvP AS SELECT * FROM main.StatPvP')
+        mem_conn.commit()
+
+        mem_cur.close()
+        mem_conn.close()
+
+    return (shard_name, num_rows, list(query_log))
+
+
+def run_sharded_stats(conn, db_name):
+    '''Calculates the registered stats and PvP stats for the new hands (NewHands)
+    with SHARD_JOBS worker processes, each taking a range of table_ids with about
+    the same number of hands (see run_stats_shard). This process is the only writer:
+    the shards are copied into temporary tables and merged into (db_name) in one
+    transaction. Final, rollup, and tournament stats still run on (conn).'''
+
+    # a worker of a parallel database run can't start its own workers
+    if multiprocessing.current_process().daemon:
+        print('Shards are not available in parallel database jobs; calculating in memory')
+        run_memory_stats(conn, db_name)
+        return
+
+    cur = conn.cursor()
+
+    # contiguous table_id ranges with about the same number of new hands
+    cur.execute('SELECT table_id, COUNT(*) FROM NewHands GROUP BY table_id ORDER BY table_id')
+    count_list = cur.fetchall()
+    shard_hands = sum([num_hands for (_, num_hands) in count_list]) / SHARD_JOBS
+    shard_list = []
+    num_hands_sum = 0
+    for (table_id, num_hands) in count_list:
+        if not shard_list or num_hands_sum >= shard_hands * len(shard_list):
+            shard_list.append([table_id, table_id])
+        shard_list[-1][1] = table_id
+        num_hands_sum += num_hands
+
+    # workers read the committed database
+    conn.commit()
+
+    print(f'Calculating stats in {len(shard_list)} shards...')
+    with tempfile.TemporaryDirectory() as shard_dir:
+        arg_list = [(db_name, tuple(table_range), os.path.join(shard_dir, f'shard_{i}.sqlite'))
+                    for (i, table_range) in enumerate(shard_list)]
+        with multiprocessing.Pool(len(arg_list), initializer=load_config) as pool:
+            result_list = pool.starmap(run_stats_shard, arg_list)
+
+        # ATTACH is not allowed in a transaction, so each shard is copied
+        # into temporary tables first and merged afterwards
+        for (i, (shard_name, num_rows, shard_log)) in enumerate(result_list):
+            print(f'...Shard {i + 1} (tables {shard_list[i][0]}-{shard_list[i][1]}): {num_rows} rows')
+            query_log.extend(shard_log)
+            cur.execute('ATTACH DATABASE ? AS shard', (shard_name,))
+            if i == 0:
+                cur.execute('CREATE TEMPORARY TABLE ShardPlayerHands AS SELECT * FROM shard.StatPlayerHands')
+                cur.execute('CREATE TEMPORARY TABLE ShardPvP AS SELECT * FROM shard.StatPvP')
+            else:
+                cur.execute('INSERT INTO temp.ShardPlayerHands SELECT * FROM shard.StatPlayerHands')
+                cur.execute('INSERT INTO temp.ShardPvP SELECT * FROM shard.StatPvP')
+            conn.commit()
+            cur.execute('DETACH DATABASE shard')
+
+    print('Merging stats from shards...')
+    merge_stats(cur, 'main', 'temp.ShardPlayerHands', 'temp.ShardPvP')
     conn.commit()
+
+    cur.execute('DROP TABLE temp.ShardPlayerHands')
+    cur.execute('DROP TABLE temp.ShardPvP')
     cur.close()
 
 
-def run_final_stats(conn):
-    '''Helper method for calling each of the final stats methods.'''
-        
+def set_running_totals(conn):
+    '''Sets row_num and the running bb balances (bal_bb_running) for the
+    hands without them. Called by run_final_stats, and by run_new_stats when
+    there are no new hands but the running bb balances are missing.'''
+
     cur = conn.cursor()
-    
-    # Set row_num in order
-    # used to use DESNE_RANK() instead of ROW_NUMBER() for some reason
-    subq = '''SELECT ROW_NUMBER() OVER (ORDER BY time, table_id, hand_num) rn,
-        table_id, hand_num, player_id
+
+    # Set row_num in order, continuing after the last numbered hand
+    # (renumber every hand if a new hand is older than the last numbered hand,
+    # or if the running bb balances have not been calculated yet)
+    query = '''SELECT row_num, time, table_id, hand_num, bal_bb_running
         FROM StatPlayerHands JOIN Hands USING (table_id, hand_num)
-        ORDER BY time'''
-    set_value(conn, 'row_num', 'other.rn', subq, null_only=False)
+        WHERE row_num IS NOT NULL
+        ORDER BY row_num DESC LIMIT 1'''
+    cur.execute(query)
+    last_row = cur.fetchone()
+    query = '''SELECT time, table_id, hand_num
+        FROM StatPlayerHands JOIN Hands USING (table_id, hand_num)
+        WHERE row_num IS NULL
+        ORDER BY time, table_id, hand_num LIMIT 1'''
+    cur.execute(query)
+    first_new = cur.fetchone()
+    renumber = last_row is None or last_row[4] is None \
+        or (first_new is not None and first_new < last_row[1:4])
+
+    # used to use DESNE_RANK() instead of ROW_NUMBER() for some reason
+    if renumber:
+        subq = '''SELECT ROW_NUMBER() OVER (ORDER BY time, table_id, hand_num) rn,
+            table_id, hand_num, player_id
+            FROM StatPlayerHands JOIN Hands USING (table_id, hand_num)
+            ORDER BY time'''
+        set_value(conn, 'row_num', 'other.rn', subq, null_only=False)
+    elif first_new is not None:
+        subq = '''SELECT ROW_NUMBER() OVER (ORDER BY time, table_id, hand_num) + ? rn,
+            table_id, hand_num, player_id
+            FROM StatPlayerHands JOIN Hands USING (table_id, hand_num)
+            WHERE row_num IS NULL
+            ORDER BY time'''
+        set_value(conn, 'row_num', 'other.rn', subq, values=(last_row[0],))
 
     # Calculate running bb balances
     # (Tableau calculates these natively, but Power BI is a disaster)
-    """
-    subq = '''SELECT player_id, row_num, balance_bb,
-        SUM(balance_bb) OVER (PARTITION BY player_id ORDER BY row_num) AS running_total
-        FROM StatPlayerHands
-        ORDER BY player_id'''
-    set_value(conn, 'bal_bb_running', 'other.running_total', subq,
-              match_row=True, null_only=False)
-    """
+    if renumber:
+        subq = '''SELECT player_id, row_num, balance_bb,
+            SUM(balance_bb) OVER (PARTITION BY player_id ORDER BY row_num) AS running_total
+            FROM StatPlayerHands
+            ORDER BY player_id'''
+        set_value(conn, 'bal_bb_running', 'other.running_total', subq,
+                  match_row=True, null_only=False)
+    elif first_new is not None:
+        # each player's new hands continue from their last running total
+        subq = '''WITH LastTotals AS
+            (SELECT player_id,
+             (SELECT bal_bb_running FROM StatPlayerHands AS prev
+              WHERE prev.player_id = Players.player_id AND prev.row_num <= ?
+              ORDER BY prev.row_num DESC LIMIT 1) AS last_total
+             FROM (SELECT DISTINCT player_id FROM StatPlayerHands WHERE row_num > ?) AS Players)
+            SELECT player_id, row_num, balance_bb,
+            IFNULL(last_total, 0)
+             + SUM(balance_bb) OVER (PARTITION BY player_id ORDER BY row_num) AS running_total
+            FROM StatPlayerHands JOIN LastTotals USING (player_id)
+            WHERE row_num > ?
+            ORDER BY player_id'''
+        set_value(conn, 'bal_bb_running', 'other.running_total', subq, values=(last_row[0],) * 3,
+                  match_row=True, null_only=False)
+    cur.close()
+
+
+def run_final_stats(conn):
+    '''Helper method for calling each of the final stats methods.'''
+        
+    cur = conn.cursor()
     
+    set_running_totals(conn)
+
     # Set sess_num in order
     print('sess_num', end=' ')
-    end_time = '2099-12-31'
-    recent_cur = split_sessions(conn, return_all=True)
-    for row in recent_cur:
-        # print(row)
-        begin_time = row[0]
-        sess_num = row[5]
-        """
-        query = '''UPDATE StatPlayerHands
-                SET sess_num = ?
-                WHERE table_id IN
-                (SELECT table_id
-                FROM TableNames
-                WHERE time >= ? AND time < ?)'''
-        """
-        query = '''UPDATE TableNames
-                        SET sess_num = ?
-                        WHERE time >= ? AND time < ?'''
-        values = (sess_num, begin_time, end_time)
-        cur.execute(query, values)
-        end_time = begin_time
-    
-    recent_cur.close()
-
-    # Above query doesn't work for first session in db
+    set_sessions(conn)
+
+    # Above query doesn't set tables without a time
     query = 'UPDATE TableNames SET sess_num = 1 WHERE sess_num IS NULL'
     # query = 'UPDATE TableNames SET sess_num = 1 WHERE time = (SELECT MIN(time) FROM TableNames)'
     cur.execute(query)
@@ -1109,31 +2685,85 @@ def run_final_stats(conn):
     # set_value(conn, 'sess_num', 'other.sn', subq, values=(TIME_DIFF,),
     #           match_player=False, null_only=False)
         
-    # Set timestamp
-    calc_action(conn, 'date_added', 'True', val='CURRENT_TIMESTAMP')
+    # Set timestamp, in milliseconds so that each batch of hands has its own
+    # (CURRENT_TIMESTAMP is in seconds; see export_stats)
+    calc_action(conn, 'date_added', 'True', val="strftime('%Y-%m-%d %H:%M:%f', 'now')")
+    clear_stat_queue(conn)
     
-    conn.commit()
+    commit_stats(conn)
+    cur.close()
+
+
+def create_touched_sessions_table(conn):
+    '''Creates temporary table of tournament sessions (sess_num) whose stats
+    need to be recalculated: sessions with new hands (NewHands), both the old
+    and new numbers of sessions whose tables were renumbered by set_sessions()
+    or whose tourney actions are new, and sessions whose sess_hand does not
+    start at 1 (numbered across all sessions by older versions).
+    Returns the number of sessions.'''
+
+    cur = conn.cursor()
+
+    # sess_hand check is one index lookup per session (see create_indexes)
+    cur.execute('DROP TABLE IF EXISTS temp.TouchedSessions')
+    query = '''CREATE TEMPORARY TABLE TouchedSessions AS
+        SELECT tn.sess_num
+        FROM temp.NewHands JOIN TableNames tn USING (table_id)
+        UNION
+        SELECT sess_num
+        FROM (SELECT DISTINCT sess_num FROM TableNames) AS s
+        WHERE (SELECT MIN(sth.sess_hand) FROM StatTourneyHands sth
+               WHERE sth.sess_num = s.sess_num) <> 1
+        UNION
+        SELECT ta.sess_num
+        FROM TourneyActions ta JOIN TableNames tn USING (table_id)
+        WHERE ta.sess_num IS NOT tn.sess_num
+        UNION
+        SELECT tn.sess_num
+        FROM TourneyActions ta JOIN TableNames tn USING (table_id)
+        WHERE ta.sess_num IS NOT tn.sess_num
+        UNION
+        SELECT sth.sess_num
+        FROM StatTourneyHands sth JOIN TableNames tn USING (table_id)
+        WHERE sth.sess_num IS NOT tn.sess_num
+        UNION
+        SELECT tn.sess_num
+        FROM StatTourneyHands sth JOIN TableNames tn USING (table_id)
+        WHERE sth.sess_num IS NOT tn.sess_num'''
+    cur.execute(query)
+    cur.execute('DELETE FROM TouchedSessions WHERE sess_num IS NULL')
+
+    cur.execute('SELECT COUNT(*) FROM TouchedSessions')
+    num_sessions = cur.fetchone()[0]
+    print(f'Number of tournament sessions to update: {num_sessions}')
+
     cur.close()
 
+    return num_sessions
+
 
 def run_tourney_stats(conn):
-    '''Helper method for calling tournament stats.'''
+    '''Helper method for calling tournament stats.
+    Only the sessions in TouchedSessions are recalculated
+    (see create_touched_sessions_table).'''
 
     print()
     print('Calculating tournament stats...')
 
+    if create_touched_sessions_table(conn) == 0:
+        return
+
     cur = conn.cursor()
 
     # add sess_num to TourneyActions
     # can't rely on JOIN with TableNames because later DELETE won't work
     query = '''UPDATE TourneyActions
-    SET sess_num = (
-      SELECT tn.sess_num
-      FROM TableNames AS tn
-      WHERE TourneyActions.table_id = tn.table_id
-    );'''
-    cur.execute(query)
-    conn.commit()
+    SET sess_num = tn.sess_num
+    FROM TableNames AS tn
+    WHERE TourneyActions.table_id = tn.table_id
+      AND TourneyActions.sess_num IS NOT tn.sess_num'''
+    execute_query(cur, query, label='tourney_sess_num')
+    commit_stats(conn)
 
     # add prev_action_id to TourneyActions
     # also not strictly necessary, but makes queries easier
@@ -1145,24 +2775,31 @@ def run_tourney_stats(conn):
           AND ta.player_id = ta2.player_id
           AND ta.time > ta2.time
         ORDER BY ta2.time DESC
-        LIMIT 1)'''
-    cur.execute(query)
-    conn.commit()
+        LIMIT 1)
+    WHERE ta.sess_num IN TouchedSessions'''
+    execute_query(cur, query, label='tourney_prev_action_id')
+    commit_stats(conn)
 
     # delete rows from TourneyActions where a player enters the game but did not previously quit
     # necessary to deal with the hand history ambiguity
     # need to manually fix hand histories where a player changed names but the timestamp for the old name quitting
     #  is later than the timestamp of the new name joining
     query = '''DELETE FROM TourneyActions
-        WHERE t_action_id = ? AND prev_action_id > ?'''
+        WHERE t_action_id = ? AND prev_action_id > ?
+          AND sess_num IN TouchedSessions'''
     values = (BUYIN_VAL, QUIT_VAL)
     cur.execute(query, values)
 
+    # clear previous results for the sessions being recalculated
+    cur.execute('DELETE FROM StatTourneyPlaces WHERE sess_num IN TouchedSessions')
+    cur.execute('DELETE FROM StatTourneyHands WHERE sess_num IN TouchedSessions')
+
     # find tournament winners
     query = '''SELECT sess_num, 1 as place, player_id
         FROM (
             SELECT ta.sess_num, ta.player_id, t_action_id AS recent_action, MAX(ta.time)
             FROM TourneyActions ta
+            WHERE ta.sess_num IN TouchedSessions
             GROUP BY ta.sess_num, ta.player_id
         ) AS recent_action_subquery
         WHERE recent_action > ?'''
@@ -1179,6 +2816,7 @@ def run_tourney_stats(conn):
           SELECT ta.*
           FROM TourneyActions ta
           WHERE ta.t_action_id = ?
+            AND ta.sess_num IN TouchedSessions
             AND NOT EXISTS (
               SELECT 1
               FROM TourneyActions ta2
@@ -1213,128 +2851,423 @@ def run_tourney_stats(conn):
 
     # insert session hand number, total stacks, and total active players into StatTourneyHands
     # sess_num is again not strictly necessary but much more readable
-    query = '''INSERT INTO StatTourneyHands (sess_num, sess_hand, table_id, hand_num, total_stacks, total_players)
-        SELECT tn.sess_num,
-        ROW_NUMBER() OVER (ORDER BY h.time, h.table_id, h.hand_num) AS sess_hand,
-        h.table_id, h.hand_num,
-        (
-            SELECT SUM(ta.amount)
-            FROM TourneyActions ta
-            WHERE ta.sess_num = tn.sess_num AND ta.time <= h.time
-        ) AS total_stacks,
-        (
-            SELECT COUNT(*)
-            FROM (
-                SELECT ta.sess_num, ta.player_id, t_action_id AS recent_action, MAX(ta.time)
-                FROM TourneyActions ta
-                WHERE ta.sess_num = tn.sess_num AND ta.time <= h.time
-                GROUP BY ta.sess_num, ta.player_id
-            ) AS recent_action_subquery
-            WHERE recent_action > 0
-        ) AS total_players
-        FROM Hands h JOIN TableNames tn USING (table_id)
-        ORDER BY h.time'''
-    cur.execute(query)
+    # sess_hand is numbered within each session, so other sessions don't need renumbering
+    # one pass over TourneyActions and Hands merged in time order (per sess_num):
+    # running SUM of amounts for total_stacks, and running SUM of each player's change in
+    # active status (their most recent action > 0) for total_players
+    # tourney actions come before hands with the same time (ta.time <= h.time)
+    # among a player's actions with the same time, the first row counts as most recent
+    query = '''WITH PlayerActions AS
+            (SELECT sess_num, time, amount,
+             COALESCE(t_action_id > 0, 0)
+             - COALESCE(LAG(t_action_id > 0) OVER (PARTITION BY sess_num, player_id
+                                                   ORDER BY time, rowid DESC), 0) AS active_change
+            FROM TourneyActions
+            WHERE sess_num IN TouchedSessions),
+        Events AS
+            (SELECT sess_num, time, 0 AS is_hand, NULL AS table_id, NULL AS hand_num,
+             amount, active_change
+            FROM PlayerActions
+            UNION ALL
+            SELECT tn.sess_num, h.time, 1 AS is_hand, h.table_id, h.hand_num,
+             NULL AS amount, 0 AS active_change
+            FROM Hands h JOIN TableNames tn USING (table_id)
+            WHERE tn.sess_num IN TouchedSessions),
+        RunningTotals AS
+            (SELECT sess_num, time, is_hand, table_id, hand_num,
+             SUM(amount) OVER sess_win AS total_stacks,
+             SUM(active_change) OVER sess_win AS total_players
+            FROM Events
+            WINDOW sess_win AS (PARTITION BY sess_num ORDER BY time, is_hand
+                                ROWS UNBOUNDED PRECEDING))
+        INSERT INTO StatTourneyHands (sess_num, sess_hand, table_id, hand_num, total_stacks, total_players)
+        SELECT sess_num,
+        ROW_NUMBER() OVER (PARTITION BY sess_num ORDER BY time, table_id, hand_num) AS sess_hand,
+        table_id, hand_num, total_stacks, total_players
+        FROM RunningTotals
+        WHERE is_hand = 1
+        ORDER BY time'''
+    execute_query(cur, query, label='tourney_hands')
 
-    conn.commit()
+    cur.execute('DROP TABLE temp.TouchedSessions')
+    commit_stats(conn)
     cur.close()
 
 
-def run_small_db(source_db):
-    '''Create the small (monthly) db.'''
-    
-    # copy to small db
-    print(f'Copying {source_db} to {SMALL_DB_NAME}...')
-    shutil.copyfile(source_db, SMALL_DB_NAME)
-    
-    # small_conn = sqlite3.connect(SMALL_DB_NAME)
-    # context statement for the win!
-    with sqlite3.connect(SMALL_DB_NAME) as small_conn:
-        small_cur = small_conn.cursor()
-    
-        # find begin date within SMALL_DAYS
-        begin_date = split_sessions(small_conn, num_days=SMALL_DAYS)
-        # print(f'Begin date: {begin_date}')
+def write_parquet_parts(conn, query, values, col_list, table_dir, part_name, file_name):
+    '''Writes the rows of (query) with (values) to Parquet files named (file_name)
+    in (table_dir), one file per partition. The query's first column is the
+    partition value (part_name) and is not written to the files; the other columns
+    are named and typed by (col_list), a list of (name, declared SQLite type) tuples.
+    Returns the number of rows written.'''
 
-        # remove all tables other than those needed by Tableau
-        print('Removing unnecessary tables...')
-        table_list = ['ActionNames', 'Actions', 'Aliases', 'Stats']
-        # table_list = ['Aliases']
-        for table_name in table_list:
-            print(f'...Deleting {table_name}')
-            query = f'DROP TABLE IF EXISTS {table_name}'
-            small_cur.execute(query)
+    # imported here so that pyarrow is only needed when exporting
+    import pyarrow
+    import pyarrow.parquet
 
-        # find db table names
-        query = '''SELECT name FROM sqlite_master
-                WHERE type='table'
-                ORDER BY name'''
-        small_cur.execute(query)
-        table_list = small_cur.fetchall()
-        
-        # add TableNames db table last (otherwise query will fail!)
-        try:
-            table_list.remove(('TableNames',))
-        except ValueError:
-            print('No TableNames table found')
-        table_list.append(('TableNames',))
-        
-        print(f'Deleting old hands before {begin_date}...')
-        # print(table_list)
-        
-        # go through each db table and delete all data older than begin date
-        for table_tuple in table_list:
-            table_name = table_tuple[0]
-            
-            query = f'DELETE FROM {table_name} WHERE table_id IN'
-            query += ''' (SELECT table_id FROM TableNames
-                    WHERE time < ?
-                    GROUP BY table_id)'''
-            
+    type_dict = {'INTEGER': pyarrow.int64(), 'BOOLEAN': pyarrow.bool_(), 'FLOAT': pyarrow.float64(),
+                 'REAL': pyarrow.float64()}
+    schema = pyarrow.schema([(col, type_dict.get(col_type.upper(), pyarrow.string()))
+                             for (col, col_type) in col_list])
+
+    cur = conn.cursor()
+    cur.execute(query, values)
+
+    num_rows = 0
+    for (part, row_iter) in itertools.groupby(cur, key=lambda row: row[0]):
+        row_list = [row[1:] for row in row_iter]
+        array_list = []
+        for (i, field) in enumerate(schema):
+            val_list = [row[i] for row in row_list]
+            if field.type == pyarrow.bool_():
+                val_list = [None if val is None else bool(val) for val in val_list]
+            array_list.append(pyarrow.array(val_list, type=field.type))
+
+        # Hive-style partition directories, e.g. StatPlayerHands/month=2022-01
+        part_dir = os.path.join(table_dir, f'{part_name}={part}')
+        os.makedirs(part_dir, exist_ok=True)
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(array_list, schema=schema),
+                                    os.path.join(part_dir, f'{file_name}.parquet'))
+        num_rows += len(row_list)
+
+    cur.close()
+
+    return num_rows
+
+
+def export_stats(conn, db_name):
+    '''Exports StatPlayerHands, StatPvP, and the tournament stat tables of (db_name)
+    to Parquet files for BI tools, in EXPORT_DIR/<database name>/<table>/.
+    StatPlayerHands and StatPvP are partitioned by EXPORT_PARTITION ('month' or 'sess_num')
+    and the tournament tables by sess_num.
+    In incremental mode (EXPORT_INCREMENTAL), only hands added since the last export
+    (by date_added, which is in milliseconds) are written, as new files in their
+    partitions, named after the last date_added. Everything is
+    exported again when the columns of StatPlayerHands have changed.
+    The tournament tables are small and are rewritten by every export.
+    Needs the optional pyarrow package.'''
+
+    try:
+        import pyarrow
+    except ImportError:
+        print('Skipping export: the pyarrow package is not installed (pip install pyarrow)')
+        return
+
+    if EXPORT_PARTITION == 'month':
+        part_str = "strftime('%Y-%m', h.time) AS month"
+    elif EXPORT_PARTITION == 'sess_num':
+        part_str = 'tn.sess_num'
+    else:
+        raise ValueError(f'Unknown export partition: {EXPORT_PARTITION}')
+
+    cur = conn.cursor()
+
+    db_stem = os.path.splitext(os.path.basename(db_name))[0]
+    out_dir = os.path.join(EXPORT_DIR, db_stem)
+    state_path = os.path.join(out_dir, 'export_state.json')
+
+    cur.execute('PRAGMA table_info(StatPlayerHands)')
+    sph_list = [(row[1], row[2]) for row in cur.fetchall()]
+
+    # start over unless the last export has the same columns
+    state = {}
+    if EXPORT_INCREMENTAL and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get('columns') != [col for (col, _) in sph_list] or state.get('partition') != EXPORT_PARTITION:
+            print('...Columns or partitions changed since the last export; exporting all hands')
+            state = {}
+    if not state and os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    last_added = state.get('date_added', '')
+
+    cur.execute('SELECT MAX(date_added) FROM StatPlayerHands')
+    max_added = cur.fetchone()[0]
+    if max_added is None:
+        print('No stats to export')
+        cur.close()
+        return
+    # one file per batch of hands, e.g. part_20240101_203015_123
+    digits = ''.join([c for c in max_added if c.isdigit()])
+    file_name = f'part_{digits[:8]}_{digits[8:14]}_{digits[14:17]}'.rstrip('_')
+
+    '''
+    The general form of the query is
+     SELECT <partition>, <table>.* FROM <table>
+     JOIN StatPlayerHands JOIN Hands JOIN TableNames
+     WHERE date_added > <last export>
+     ORDER BY <partition>
+    '''
+
+    print(f'Exporting stats to {out_dir}...')
+    from_str = '''
+        FROM StatPlayerHands AS sph JOIN Hands AS h USING (table_id, hand_num)
+        JOIN TableNames AS tn USING (table_id)'''
+    where_str = '''
+        WHERE sph.date_added > ? AND sph.date_added <= ?
+        ORDER BY 1'''
+    query = f'SELECT {part_str}, sph.*' + from_str + where_str
+    num_rows = write_parquet_parts(conn, query, (last_added, max_added), sph_list,
+                                   os.path.join(out_dir, 'StatPlayerHands'), EXPORT_PARTITION, file_name)
+    print(f'...Wrote {num_rows} rows of StatPlayerHands')
+
+    cur.execute('PRAGMA table_info(StatPvP)')
+    pvp_list = [(row[1], row[2]) for row in cur.fetchall()]
+    query = f'SELECT {part_str}, pvp.*' + from_str \
+        + '\n        JOIN StatPvP AS pvp USING (table_id, hand_num, player_id)' + where_str
+    num_rows = write_parquet_parts(conn, query, (last_added, max_added), pvp_list,
+                                   os.path.join(out_dir, 'StatPvP'), EXPORT_PARTITION, file_name)
+    print(f'...Wrote {num_rows} rows of StatPvP')
+
+    # tournament tables are rewritten
+    for table_name in ['StatTourneyHands', 'StatTourneyPlaces']:
+        table_dir = os.path.join(out_dir, table_name)
+        if os.path.exists(table_dir):
+            shutil.rmtree(table_dir)
+        cur.execute(f'PRAGMA table_info({table_name})')
+        # sess_num is only in the partition directories
+        col_list = [(row[1], row[2]) for row in cur.fetchall() if row[1] != 'sess_num']
+        query = 'SELECT sess_num, ' + ', '.join([col for (col, _) in col_list]) \
+            + f' FROM {table_name} ORDER BY sess_num'
+        num_rows = write_parquet_parts(conn, query, (), col_list, table_dir, 'sess_num', file_name)
+        if num_rows > 0:
+            print(f'...Wrote {num_rows} rows of {table_name}')
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump({'date_added': max_added, 'partition': EXPORT_PARTITION,
+                   'columns': [col for (col, _) in sph_list]}, f, indent=1)
+
+    cur.close()
+
+
+def packed_flags_sql(cur):
+    '''Returns the SQL for the compact layout of StatPlayerHands in the attached
+    database 'source' as a tuple of (create query, select string, view query).
+    The BOOLEAN helper columns are packed into INTEGER bitmasks (flags_0, flags_1, ...,
+    63 flags each) in the table StatPlayerHandsPacked, and the view StatPlayerHands
+    unpacks them with the same column names and order, as 1 or NULL.'''
+
+    cur.execute('PRAGMA source.table_info(StatPlayerHands)')
+    col_list = [(row[1], row[2]) for row in cur.fetchall()]
+    flag_list = [col for (col, col_type) in col_list if col_type.upper() == 'BOOLEAN']
+    num_masks = (len(flag_list) + 62) // 63
+
+    '''
+    The general form of the queries is
+     CREATE TABLE StatPlayerHandsPacked (<other cols>, flags_0 INTEGER, ...)
+     SELECT <other cols>, ((vpip IS TRUE) << 0) | ((pfr IS TRUE) << 1) | ... AS flags_0, ...
+     CREATE VIEW StatPlayerHands AS
+      SELECT row_num, ..., NULLIF((flags_0 >> 0) & 1, 0) AS vpip, ... FROM StatPlayerHandsPacked
+    '''
+
+    create_list = [f'{col} {col_type}' for (col, col_type) in col_list if col not in flag_list]
+    select_list = [col for (col, _) in col_list if col not in flag_list]
+    for i in range(num_masks):
+        create_list.append(f'flags_{i} INTEGER')
+        select_list.append(' | '.join([f'(({col} IS TRUE) << {j})'
+                                       for (j, col) in enumerate(flag_list[i * 63:(i + 1) * 63])]))
+    create_query = 'CREATE TABLE StatPlayerHandsPacked\n        (' + ',\n         '.join(create_list) \
+        + ',\n         UNIQUE(table_id, hand_num, player_id)\n        )'
+
+    view_list = []
+    for (col, _) in col_list:
+        if col in flag_list:
+            (i, j) = divmod(flag_list.index(col), 63)
+            view_list.append(f'NULLIF((flags_{i} >> {j}) & 1, 0) AS {col}')
+        else:
+            view_list.append(col)
+    view_query = 'CREATE VIEW StatPlayerHands AS\n        SELECT ' + ',\n         '.join(view_list) \
+        + '\n        FROM StatPlayerHandsPacked'
+
+    return (create_query, ', '.join(select_list), view_query)
+
+
+def copy_small_db(small_conn, begin_date):
+    '''Copies the attached database 'source' into an empty small database
+    (small_conn), keeping only the hands from tables that begin on or after
+    (begin_date). Tables are created and filled with INSERT ... SELECT,
+    then indexes, views, and triggers are created on the smaller data,
+    which is then analyzed for the query planner.'''
+
+    small_cur = small_conn.cursor()
+
+    # skip all tables other than those needed by Tableau
+    skip_list = ['ActionNames', 'Actions', 'Aliases', 'Stats', 'StatQueue', 'StatQueuePlayerHands']
+
+    # tables first, then everything that depends on them
+    query = '''SELECT type, name, tbl_name, sql FROM source.sqlite_master
+            WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            ORDER BY type != 'table', name'''
+    small_cur.execute(query)
+    object_list = small_cur.fetchall()
+
+    small_cur.execute("SELECT 1 FROM source.sqlite_master WHERE type = 'table' AND name = 'TableNames'")
+    has_table_names = small_cur.fetchone() is not None
+    if not has_table_names:
+        print('No TableNames table found')
+
+    print(f'Copying hands since {begin_date}...')
+    for (object_type, name, tbl_name, sql) in object_list:
+        if tbl_name in skip_list or name in skip_list:
+            print(f'...Skipped {name}')
+            continue
+
+        # optional compact layout of StatPlayerHands (see packed_flags_sql)
+        # (a small db that is already compact has a view named StatPlayerHands instead)
+        select_str = '*'
+        dest_name = name
+        view_query = None
+        if COMPACT_FLAGS and tbl_name == 'StatPlayerHands' and object_type != 'view':
+            if object_type == 'table':
+                (sql, select_str, view_query) = packed_flags_sql(small_cur)
+                dest_name = 'StatPlayerHandsPacked'
+            elif object_type == 'index':
+                sql = sql.replace(' ON StatPlayerHands ', ' ON StatPlayerHandsPacked ', 1)
+            else:
+                print(f'...Skipped {name}')
+                continue
+
+        small_cur.execute(sql)
+        if object_type != 'table':
+            continue
+
+        # only keep data from tables that begin on or after begin date
+        # (rows without a matching old table are kept, as with the old DELETE)
+        small_cur.execute(f'PRAGMA source.table_info({name})')
+        col_list = [row[1] for row in small_cur.fetchall()]
+        query = f'INSERT INTO main.{dest_name} SELECT {select_str} FROM source.{name}'
+        values = ()
+        if has_table_names and 'table_id' in col_list:
+            query += ''' WHERE (table_id IN
+                    (SELECT table_id FROM source.TableNames
+                    WHERE time < ?)) IS NOT TRUE'''
             values = (begin_date,)
-            try:
-                small_cur.execute(query, values)
-                print(f'...Removed old hands from {table_name}')
-            except sqlite3.OperationalError:
-                # no 'table_id' column found for this particular table
-                print(f'...Skipped {table_name}')
-            
-            # end for block
-        
-        # replace player last names
-        print('Replacing last names...')
-        query = '''UPDATE PlayerNames
-                SET last_name = SUBSTR(last_name, 1, 1)'''
-        small_cur.execute(query)
-        
-        # remove owner hole cards
-        print('Removing owner hole cards...')
-        query = '''UPDATE PlayerHands
-                SET own_c1 = NULL, own_c2 = NULL'''
-        small_cur.execute(query)
-        
-        # end 'with' context statement
-        
-    print('Reducing file size...')
-    small_conn = sqlite3.connect(SMALL_DB_NAME)
-    small_conn.execute('VACUUM')
+        small_cur.execute(query, values)
+        print(f'...Copied {small_cur.rowcount} rows to {dest_name}')
+        if view_query is not None:
+            small_cur.execute(view_query)
+
+    # keep AUTOINCREMENT counters
+    small_cur.execute("SELECT 1 FROM main.sqlite_master WHERE name = 'sqlite_sequence'")
+    if small_cur.fetchone() is not None:
+        small_cur.execute('DELETE FROM main.sqlite_sequence')
+        small_cur.execute('INSERT INTO main.sqlite_sequence SELECT * FROM source.sqlite_sequence')
+
+    # planner statistics (sqlite_stat1) for dashboard queries, from the smaller data
+    small_cur.execute('ANALYZE main')
+
     small_conn.commit()
-    
+    small_cur.close()
+
+
+def run_small_db(source_db, small_list=None):
+    '''Create the small (monthly) db.
+    Optional (small_list) is a list of (out_name, num_days) tuples to create
+    several small databases from one read of (source_db); by default, creates
+    SMALL_DB_NAME with SMALL_DAYS.
+    Each small database is built from scratch with ATTACH and INSERT ... SELECT.
+    Longer windows are built first, and each shorter window is copied from the
+    previous small database instead of the full source.'''
+
+    if small_list is None:
+        small_list = [(SMALL_DB_NAME, SMALL_DAYS)]
+
+    # find begin date within num_days for each small db
+    with sqlite3.connect(source_db) as source_conn:
+        begin_list = []
+        for (small_name, num_days) in small_list:
+            begin_date = split_sessions(source_conn, num_days=num_days)
+            begin_list.append((begin_date, small_name))
+            # print(f'Begin date: {begin_date}')
+    source_conn.close()
+
+    # oldest begin date (most hands) first, so each previous small db has every hand
+    # the next one needs (other tables are copied whole, and the names are already replaced)
+    begin_list.sort()
+    copy_from = source_db
+    for (begin_date, small_name) in begin_list:
+        if os.path.exists(small_name):
+            os.remove(small_name)
+
+        print()
+        print(f'Copying {copy_from} to {small_name}...')
+
+        # context statement for the win!
+        with sqlite3.connect(small_name) as small_conn:
+            small_conn.execute('ATTACH DATABASE ? AS source', (copy_from,))
+            copy_small_db(small_conn, begin_date)
+            small_conn.execute('DETACH DATABASE source')
+
+            small_cur = small_conn.cursor()
+
+            # replace player last names
+            print('Replacing last names...')
+            query = '''UPDATE PlayerNames
+                    SET last_name = SUBSTR(last_name, 1, 1)'''
+            small_cur.execute(query)
 
-# main body
-if __name__ == '__main__':
+            # remove owner hole cards
+            print('Removing owner hole cards...')
+            query = '''UPDATE PlayerHands
+                    SET own_c1 = NULL, own_c2 = NULL'''
+            small_cur.execute(query)
+
+            # end 'with' context statement
+
+        small_conn.close()
+        copy_from = small_name
+
+
+def load_config(config_name='config.toml'):
+    '''Loads the config file (config_name) into the global settings and
+    constants. Called by the main body and by each parallel job.'''
+
+    global TEST_RUN, TIME_DIFF, EXPLAIN_PLAN, STATS_ENGINE, BATCH_COMMIT, BATCH_GROUPS, \
+           BATCH_JOURNAL_MODE, BATCH_CACHE_SIZE, CHUNK_HANDS, IN_MEMORY, SHARD_JOBS, STAT_QUEUE, \
+           PROFILE, PROFILE_DIR, PROFILE_FORMAT, PROFILE_PLAN, EXPORT_STATS, EXPORT_DIR, \
+           EXPORT_PARTITION, EXPORT_INCREMENTAL, SMALL_DB_NAME, SMALL_DAYS, SMALL_DB_LIST, \
+           COMPACT_FLAGS, CREATE_SMALL, DB_LIST, POST_VAL, POST_MISSING_VAL, POST_MISSED_VAL, \
+           FOLD_VAL, CHECK_VAL, CALL_VAL, BET_VAL, RAISE_VAL, QUIT_VAL, BUYIN_VAL, REBUY_VAL, \
+           PREFLOP_VAL, FLOP_VAL, TURN_VAL, RIVER_VAL, SHOWDOWN_VAL, STRADDLE_VAL, BB_VAL, SB_VAL, \
+           POS_MIN, POS_MAX
 
     # import config file
-    with open('config.toml', mode='rb') as f:
+    with open(config_name, mode='rb') as f:
         config = tomllib.load(f)
 
     TEST_RUN = config['test_run']
     TIME_DIFF = config['time_diff']
+    EXPLAIN_PLAN = config.get('explain_plan', False)
+    STATS_ENGINE = config.get('stats_engine', 'sql')
+    BATCH_COMMIT = config.get('batch', {}).get('batch_commit', False)
+    BATCH_GROUPS = config.get('batch', {}).get('num_groups', 0)
+    BATCH_JOURNAL_MODE = config.get('batch', {}).get('journal_mode', 'WAL')
+    BATCH_CACHE_SIZE = config.get('batch', {}).get('cache_size', -262144)
+    CHUNK_HANDS = config.get('batch', {}).get('chunk_hands', 0)
+    IN_MEMORY = config.get('batch', {}).get('in_memory', False)
+    SHARD_JOBS = config.get('batch', {}).get('shard_jobs', 0)
+    STAT_QUEUE = config.get('batch', {}).get('stat_queue', False)
+    PROFILE = config.get('profile', {}).get('profile_queries', False)
+    PROFILE_DIR = config.get('profile', {}).get('out_dir', 'profile')
+    PROFILE_FORMAT = config.get('profile', {}).get('out_format', 'json')
+    PROFILE_PLAN = config.get('profile', {}).get('query_plan', False)
+    EXPORT_STATS = config.get('export', {}).get('export_stats', False)
+    EXPORT_DIR = config.get('export', {}).get('out_dir', 'export')
+    EXPORT_PARTITION = config.get('export', {}).get('partition', 'month')
+    EXPORT_INCREMENTAL = config.get('export', {}).get('incremental', True)
     if TEST_RUN:
         SMALL_DB_NAME = config['small_db']['out_name_test']
     else:
         SMALL_DB_NAME = config['small_db']['out_name']
     SMALL_DAYS = config['small_db']['num_days']
+    COMPACT_FLAGS = config['small_db'].get('compact_flags', False)
+    SMALL_DB_LIST = [(SMALL_DB_NAME, SMALL_DAYS)]  # more small databases from the same source
+    for extra in config['small_db'].get('extra', []):
+        if TEST_RUN:
+            SMALL_DB_LIST.append((extra['out_name_test'], extra['num_days']))
+        else:
+            SMALL_DB_LIST.append((extra['out_name'], extra['num_days']))
     CREATE_SMALL = config['small_db']['create_small']
     DB_LIST = config['db_list']  # list of database names and settings
 
@@ -1369,62 +3302,274 @@ if __name__ == '__main__':
     POS_MIN = config['const']['POS_MIN']  # button
     POS_MAX = config['const']['POS_MAX']  # utg at 10-player table
 
-    # begin program logic
-    if TEST_RUN:
-        print('<<< TEST RUN >>>')
 
-    # loop through each database
-    main_db_actions = 0
-    source_db_name = None
-    for db in DB_LIST:
+class PrefixWriter:
+    '''File-like wrapper for stdout that starts each line with (prefix),
+    so that output from parallel jobs stays readable.
+    Writes whole lines only, so lines from different jobs don't mix.'''
 
-        real_db_name = db['db_name']
-        test_db_name = db['db_name_test']
-        is_tourney = db['is_tourney']
-        clear_db = db['clear_db']
-        if TEST_RUN:
-            db_name = test_db_name
-        else:
-            db_name = real_db_name
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.line = ''
 
-        # connect to database
-        with sqlite3.connect(db_name) as conn:
-            # conn = sqlite3.connect(db_name)
-            print()
-            print(f'******************** Connecting to database {db_name} ********************')
-
-            create_stats_table_sparse(conn, db_name, clear_db)
-            num_new_actions = create_new_actions_table(conn)
-
-            # if this is the main database (real or test run), store relevant info for copying to small database
-            if db_name == DB_LIST[0]['db_name'] or db_name == DB_LIST[0]['db_name_test']:
-                main_db_actions = num_new_actions
-                source_db_name = db_name
-
-            # skip if no new actions are added
-            if num_new_actions > 0:
-                create_new_hands_table(conn)
-
-                # create_stats_table(conn)
-
-                # call helper methods
-                run_preflop_stats(conn)
-                run_cbet_stats(conn)
-                run_stab_stats(conn)
-                run_rfi_stats(conn)
-                run_win_stats(conn)
-                run_agg_stats(conn)
-                run_counting_stats(conn)
+    def write(self, text):
+        self.line += text
+        while '\n' in self.line:
+            (line, self.line) = self.line.split('\n', 1)
+            self.stream.write(f'{self.prefix}{line}\n')
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        if self.line:
+            self.stream.write(f'{self.prefix}{self.line}\n')
+            self.stream.flush()
+            self.line = ''
+
+
+def run_new_stats(conn, db_name, is_tourney):
+    '''Calculates all stats for the new hands in (db_name), using the open
+    connection (conn). Called by run_database and, for each batch of new hands,
+    by watch_databases. Returns a tuple of (number of new actions, number of new hands).'''
+
+    num_new_hands = 0
+    if CHUNK_HANDS > 0:
+        (num_new_actions, num_new_hands) = create_chunked_actions_table(conn, CHUNK_HANDS, is_tourney)
+    else:
+        num_new_actions = create_new_actions_table(conn)
+
+    # skip if no new actions are added
+    if num_new_actions > 0:
+        num_hands = create_new_hands_table(conn)
+        if CHUNK_HANDS == 0:
+            num_new_hands = num_hands
+
+        # create_stats_table(conn)
+
+        # calculate all registered stats, then call helper methods
+        if SHARD_JOBS > 1:
+            run_sharded_stats(conn, db_name)
+        elif IN_MEMORY:
+            run_memory_stats(conn, db_name)
+        else:
+            run_hand_stats(conn, build_stat_registry())
+            with stat_group(conn, 'pvp_stats'):
                 run_pvp_stats(conn)
-                run_final_stats(conn)
+        with stat_group(conn, 'final_stats'):
+            run_final_stats(conn)
+        with stat_group(conn, 'rollup_stats'):
+            update_rollups(conn)
+
+        # run tournament stats
+        # should tournament stats be run even if no new actions are added? XXX
+        if is_tourney:
+            with stat_group(conn, 'tourney_stats'):
+                run_tourney_stats(conn)
+    else:
+        # running bb balances are otherwise only set with new hands,
+        # so an upgraded database with no new hands would never get them
+        cur = conn.cursor()
+        cur.execute('SELECT 1 FROM StatPlayerHands WHERE bal_bb_running IS NULL LIMIT 1')
+        if cur.fetchone() is not None:
+            with stat_group(conn, 'final_stats'):
+                set_running_totals(conn)
+        cur.close()
 
-                # run tournament stats
-                # should tournament stats be run even if no new actions are added? XXX
-                if is_tourney:
-                    run_tourney_stats(conn)
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS temp.NewActions')
+    cur.execute('DROP TABLE IF EXISTS temp.NewHands')
+    conn.commit()
+    cur.close()
 
+    return (num_new_actions, num_new_hands)
+
+
+def watch_databases(db_list, interval):
+    '''Keeps a connection open to each database in (db_list) and calculates the
+    stats for new hands as they arrive, checking every (interval) seconds until
+    stopped with Ctrl+C. A database is only checked when another connection
+    (e.g., history.py) has committed to it since the last check (PRAGMA data_version),
+    and open connections keep their page cache and prepared statements between batches.
+    Returns a list of (db_name, number of new actions, number of new hands) tuples.'''
+
+    watch_list = []
+    for db in db_list:
+        db_name = db['db_name_test'] if TEST_RUN else db['db_name']
+        # enough prepared statements for every stats query
+        conn = sqlite3.connect(db_name, cached_statements=512)
+        old_pragmas = set_run_pragmas(conn) if BATCH_COMMIT else None
+        # first check always runs, for hands added since the last run
+        watch_list.append({'db_name': db_name, 'is_tourney': db['is_tourney'], 'conn': conn,
+                           'old_pragmas': old_pragmas, 'data_version': None,
+                           'num_new_actions': 0, 'num_new_hands': 0})
+
+    print(f'Watching for new hands every {interval} s (Ctrl+C to stop)...')
+    try:
+        while True:
+            time.sleep(interval)
+            for watch in watch_list:
+                conn = watch['conn']
+                data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+                if data_version == watch['data_version']:
+                    continue
+                watch['data_version'] = data_version
+
+                begin_time = time.perf_counter()
+                query_log.clear()
+                if len(watch_list) > 1:
+                    writer = PrefixWriter(sys.stdout, f'[{watch["db_name"]}] ')
+                else:
+                    writer = sys.stdout
+                with contextlib.redirect_stdout(writer):
+                    insert_new_rows(conn)
+                    (num_new_actions, num_new_hands) = run_new_stats(conn, watch['db_name'],
+                                                                     watch['is_tourney'])
+                    if num_new_actions > 0 and EXPORT_STATS:
+                        export_stats(conn, watch['db_name'])
+                    print()
+                    print(f'{time.strftime("%H:%M:%S")} {watch["db_name"]}: {num_new_hands} new hands'
+                          + f' in {time.perf_counter() - begin_time:.1f} s')
+                if len(watch_list) > 1:
+                    writer.flush()
+                watch['num_new_actions'] += num_new_actions
+                watch['num_new_hands'] += num_new_hands
+    except KeyboardInterrupt:
+        print()
+        print('Stopped watching')
+
+    for watch in watch_list:
+        if watch['old_pragmas'] is not None:
+            restore_pragmas(watch['conn'], watch['old_pragmas'])
+        watch['conn'].close()
+
+    return [(watch['db_name'], watch['num_new_actions'], watch['num_new_hands']) for watch in watch_list]
+
+
+def run_database(db, prefix=''):
+    '''Calculates all stats for one database (db) from the [[db_list]] in
+    config.toml. Optional (prefix) starts each line of output (for parallel
+    jobs). Returns a tuple of (db_name, number of new actions,
+    number of new hands, elapsed seconds, list of profiled queries).'''
+
+    begin_time = time.perf_counter()
+    query_log.clear()
+
+    real_db_name = db['db_name']
+    test_db_name = db['db_name_test']
+    is_tourney = db['is_tourney']
+    clear_db = db['clear_db']
+    if TEST_RUN:
+        db_name = test_db_name
+    else:
+        db_name = real_db_name
+
+    if prefix:
+        writer = PrefixWriter(sys.stdout, prefix)
+    else:
+        writer = sys.stdout
+
+    # connect to database
+    with contextlib.redirect_stdout(writer), sqlite3.connect(db_name) as conn:
+        # conn = sqlite3.connect(db_name)
+        print()
+        print(f'******************** Connecting to database {db_name} ********************')
+
+        new_cols = create_stats_table_sparse(conn, db_name, clear_db, db.get('db_delete'))
+        create_indexes(conn)
+
+        # set before creating NewActions; changing temp_store drops temporary tables
+        if BATCH_COMMIT:
+            old_pragmas = set_run_pragmas(conn)
+
+        # calculate columns added since the last run for the existing hands
+        if new_cols:
+            calc_new_columns(conn, new_cols)
+        create_rollup_tables(conn)
+
+        (num_new_actions, num_new_hands) = run_new_stats(conn, db_name, is_tourney)
+
+        if BATCH_COMMIT:
+            restore_pragmas(conn, old_pragmas)
+
+        # write columnar files for BI tools
+        if EXPORT_STATS:
+            export_stats(conn, db_name)
+
+        # keep query planner statistics up to date for the indexes
+        conn.execute('PRAGMA optimize')
+
+        print()
+        print()
+
+        if PROFILE:
+            for row in query_log:
+                row['db_name'] = db_name
+            print('Slowest queries:')
+            for row in sorted(query_log, key=lambda row: row['seconds'], reverse=True)[:5]:
+                print(f'...{row["seconds"]:.3f} s, {row["rows"]} rows: {row["label"]}')
+            db_stem = os.path.splitext(os.path.basename(db_name))[0]
+            write_profile(query_log, f'{db_stem}_{time.strftime("%Y%m%d_%H%M%S")}')
             print()
-            print()
+
+    if prefix:
+        writer.flush()
+    conn.close()
+
+    return (db_name, num_new_actions, num_new_hands, time.perf_counter() - begin_time,
+            list(query_log))
+
+
+# main body
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calculates helper variables for poker statistics.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of databases to process at the same time (default: 1)')
+    parser.add_argument('--watch', type=float, default=0, metavar='SECONDS',
+                        help='after the run, keep calculating stats for new hands, checking every '
+                             'SECONDS seconds until stopped with Ctrl+C (default: 0, run once)')
+    args = parser.parse_args()
+
+    load_config()
+    run_stamp = time.strftime('%Y%m%d_%H%M%S')
+
+    # begin program logic
+    if TEST_RUN:
+        print('<<< TEST RUN >>>')
+
+    if args.jobs > 1:
+        # ask before starting, because parallel jobs can't prompt for input
+        db_list = []
+        for db in DB_LIST:
+            db = dict(db)
+            if db['clear_db']:
+                db_name = db['db_name_test'] if TEST_RUN else db['db_name']
+                db['db_delete'] = input(f'Clear existing stats tables for {db_name}? (Y/n): ')
+            db_list.append(db)
+
+        # each database is a separate file, so they can be processed in parallel
+        job_list = [(db, f'[{db["db_name_test"] if TEST_RUN else db["db_name"]}] ')
+                    for db in db_list]
+        with multiprocessing.Pool(min(args.jobs, len(job_list)), initializer=load_config) as pool:
+            result_list = pool.starmap(run_database, job_list)
+    else:
+        # loop through each database
+        result_list = [run_database(db) for db in DB_LIST]
+
+    # if this is the main database (real or test run), store relevant info for copying to small database
+    # results are in the same order as DB_LIST, so the main database is first
+    (source_db_name, main_db_actions, _, _, _) = result_list[0]
+
+    print('******************** Summary ********************')
+    for (db_name, num_new_actions, num_new_hands, elapsed, _) in result_list:
+        print(f'{db_name}: {num_new_actions} new actions, {num_new_hands} new hands, {elapsed:.1f} s')
+    print()
+
+    # one report for the whole run, in addition to the report for each database
+    if PROFILE:
+        write_profile([row for result in result_list for row in result[4]], f'run_{run_stamp}')
+        print()
 
     # run outside main database connection so complete db is copied
     if CREATE_SMALL:
@@ -1432,4 +3577,12 @@ if __name__ == '__main__':
         # print()
         # print(f'Pausing for {sleep_time} seconds...')
         # time.sleep(sleep_time)
-        run_small_db(source_db_name)
+        run_small_db(source_db_name, SMALL_DB_LIST)
+
+    # keep the stats current as new hands arrive (e.g., during a live session)
+    if args.watch > 0:
+        print()
+        watch_result_list = watch_databases(DB_LIST, args.watch)
+        print('******************** Watch Summary ********************')
+        for (db_name, num_new_actions, num_new_hands) in watch_result_list:
+            print(f'{db_name}: {num_new_actions} new actions, {num_new_hands} new hands')